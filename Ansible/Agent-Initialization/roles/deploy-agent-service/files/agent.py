@@ -1,37 +1,995 @@
+import collections
 import copy
-import dns.resolver
+import hashlib
 import json # Parse JSON? -- Reading the things will be dictionaries so it should not be needed
 import logging
 import logging.handlers
+import math
+import multiprocessing
 import os
 import paho.mqtt.client as mqtt # This is the library arbitraily chosen to serve as the MQTT agent
-import requests
+import prometheus_client
+import re
 import sys # System Interaction, exit
 import subprocess # Process Managment and Communcation
 import socket
-from threading import Lock, Thread
-import datetime
+import signal
+import queue
+import runpy
+import selectors
+import shutil
+import tempfile
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, Timer, get_ident
+import itertools
 import time
+import urllib.parse
+import uuid
 
+# msgpack is optional, without it everything goes out as JSON.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
-# Logging
+# Exit code reported for a check that was killed for running too long,
+# same as coreutils `timeout`.
+TIMEOUT_EXIT_CODE = 124
+
+# Longest timeout (seconds) a check message may ask for.
+MAX_CHECK_TIMEOUT = 300
+
+# How long (seconds) the output of a check that exited is still read, in case
+# something it started outside its process group holds the pipes open.
+EXIT_OUTPUT_GRACE = 0.5
+
+# Logging, the handlers are attached by setup_logging().
 logger = logging.getLogger("End_Agent")
-logger.setLevel(logging.DEBUG)
 
-# create console handler and set level to debug
-# 20 MB file limit with 1 backup
-ch = logging.handlers.RotatingFileHandler('agent.log', maxBytes=2000000, backupCount=1)
-ch.setLevel(logging.DEBUG)
 
-# create formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+        QueueHandler that leaves formatting the record to the listener
+        thread, the thread that logs only pays for the queue put.
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(path='agent.log', level=logging.INFO):
+    """
+        Log to `path` without blocking the logging thread on disk I/O.
+
+        Records are queued and written to the rotating file by a background
+        thread, the QueueListener that is returned. The level is set again
+        from log_level once the configuration is read.
+    """
+    # 2 MB file limit with 1 backup
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=2000000, backupCount=1)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
+
+
+class SampledLog:
+    """
+        For messages that come too often to log every one of them: logs the
+        first, then at most one every `interval` seconds with the number of
+        messages left out since the last one.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = Lock()
+        self.last = None
+        self.suppressed = 0
+
+    def log(self, level, msg, *args):
+        if not logger.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if self.last is not None and now - self.last < self.interval:
+                self.suppressed += 1
+                return
+            suppressed = self.suppressed
+            self.suppressed = 0
+            self.last = now
+
+        logger.log(level, msg + " (%s similar messages not logged since the last one)", *args, suppressed)
+
+# Metrics, served on metrics_port and/or published to metrics_topic.
+CHECK_RUNTIME = prometheus_client.Histogram('agent_check_runtime_seconds',
+                                            'Wall time of a check run',
+                                            ['check'],
+                                            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60))
+CHECK_QUEUE_WAIT = prometheus_client.Histogram('agent_check_queue_wait_seconds',
+                                               'Time a check waited for a free worker',
+                                               buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+CHECK_RESULTS = prometheus_client.Counter('agent_check_results_total',
+                                          'Finished checks by outcome',
+                                          ['outcome'])
+CHECKS_REFUSED = prometheus_client.Counter('agent_checks_refused_total',
+                                           'Checks the executor refused (coalesced, shed)',
+                                           ['event'])
+CHECKS_IN_FLIGHT = prometheus_client.Gauge('agent_checks_in_flight', 'Checks running on a worker right now')
+CHECKS_QUEUED = prometheus_client.Gauge('agent_checks_queued', 'Checks waiting for a free worker')
+DNS_LOOKUP = prometheus_client.Histogram('agent_dns_lookup_seconds',
+                                         'Time of a query to the blue team DNS server',
+                                         buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+SCRIPT_DOWNLOAD = prometheus_client.Histogram('agent_script_download_seconds',
+                                              'Time of a request for a check script to the checks-repo',
+                                              buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+MQTT_RECONNECTS = prometheus_client.Counter('agent_mqtt_reconnects_total',
+                                            'Times the connection to the MQTT broker came back after being lost')
+
+
+class DNSCache:
+    """
+        Cache of forward lookups against the blue team DNS server.
+
+        Positive answers are kept for as long as the record's TTL says,
+        failed lookups (NXDOMAIN, no answer, timeouts) are kept for
+        `negative_ttl` seconds so a name that does not resolve is not
+        asked about on every check message.
+    """
+    def __init__(self, dns_server, negative_ttl):
+        self.dns_server = dns_server
+        self.negative_ttl = negative_ttl
+
+        # Made on the first lookup, dnspython is slow to import and the
+        # agent connects to the broker first.
+        self.resolver = None
+
+        # name -> (expiry, set of addresses). An empty set is a negative entry.
+        self.entries = {}
+
+    def lookup(self, name):
+        """
+            Return the set of addresses `name` resolves to, from the cache
+            when the entry is still valid.
+        """
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return self.resolve(name)
+
+    def resolve(self, name):
+        """
+            Ask the DNS server about `name` and cache the answer.
+        """
+        import dns.resolver
+
+        if self.resolver is None:
+            resolver = dns.resolver.Resolver()
+            resolver.nameservers = [self.dns_server]
+            self.resolver = resolver
+
+        try:
+            with DNS_LOOKUP.time():
+                answer = self.resolver.resolve(name, "A")
+            addresses = {record.address for record in answer}
+            ttl = answer.rrset.ttl
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            addresses = set()
+            ttl = self.negative_ttl
+        except Exception as e:
+            # Timeouts and the like say nothing about the name itself,
+            # keep the last answer we had (if any) and try again later.
+            entry = self.entries.get(name)
+            addresses = entry[1] if entry is not None else set()
+            ttl = self.negative_ttl
+
+        self.entries[name] = (time.monotonic() + ttl, addresses)
+        return addresses
+
+    def expired(self, name):
+        entry = self.entries.get(name)
+        return entry is None or entry[0] <= time.monotonic()
+
+
+class RWLock:
+    """
+        Reader/writer lock. Any number of readers can hold it at once, a
+        writer holds it alone. A waiting writer keeps new readers out so a
+        busy script can't starve its refresh.
+    """
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class LockRegistry:
+    """
+        One RWLock per check script, created the first time it is asked for.
+
+        Locks are keyed by script name and, optionally, the hash of a
+        particular version of the script.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.locks = {}
+
+    def get(self, name, digest=None):
+        key = (name, digest)
+        with self.lock:
+            rwlock = self.locks.get(key)
+            if rwlock is None:
+                rwlock = self.locks[key] = RWLock()
+            return rwlock
+
+
+class ScriptCache:
+    """
+        Content addressed store of the check scripts.
+
+        A script is kept under tmp/objects/<sha256> and tmp/<script name>
+        is a hard link to the version in use. The index (tmp/index.json)
+        remembers, per script name, the hash in use, the hash of the version
+        before it and the ETag / Last-Modified the checks-repo sent with it
+        so a refresh is a conditional GET that usually comes back 304.
+
+        Only those two versions of every script are kept, an object no
+        index entry refers to any more is removed when it drops out, and
+        at startup.
+
+        A new version is written to a temporary file and renamed into place,
+        a check that is already running keeps the file it opened and the
+        next one sees the whole new script, never half of it.
+    """
+    def __init__(self, root="./tmp/", pool_size=8):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.index_path = os.path.join(root, "index.json")
+
+        os.makedirs(self.objects, exist_ok=True)
+
+        # One pooled session, keep-alive connections to the checks-repo.
+        # Made by get_session() for the first download.
+        self.pool_size = pool_size
+        self.session = None
+        self.session_lock = Lock()
+
+        # Protects self.index, index.json and self.download_locks
+        self.index_lock = Lock()
+        self.index = self.load_index()
+        self.collect_objects()
+
+        # Script name -> Lock held while the script is first downloaded.
+        self.download_locks = {}
+
+    def get_session(self):
+        # requests is only imported once something is downloaded, it is
+        # slow to import and the agent connects to the broker first.
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                import requests.adapters
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+            return self.session
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self):
+        # Caller holds self.index_lock
+        self.atomic_write(self.index_path, json.dumps(self.index).encode("utf-8"))
+
+    def atomic_write(self, path, content):
+        tmp_path = f"{path}.{os.getpid()}.{time.monotonic_ns()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def script_path(self, name):
+        return os.path.join(self.root, name)
+
+    def referenced(self):
+        # Caller holds self.index_lock
+        return {digest for entry in self.index.values()
+                for digest in (entry['hash'], entry.get('previous')) if digest}
+
+    def collect_objects(self):
+        """
+            Remove the objects no index entry refers to, e.g. versions
+            replaced before the index remembered the previous one.
+        """
+        with self.index_lock:
+            referenced = self.referenced()
+        for digest in os.listdir(self.objects):
+            if digest not in referenced and ".part" not in digest:
+                self.remove_object(digest)
+
+    def remove_object(self, digest):
+        try:
+            os.unlink(os.path.join(self.objects, digest))
+        except FileNotFoundError:
+            pass
+
+    def object_path(self, name):
+        """
+            Path of the immutable copy of the version of `name` in use, None
+            if we don't have it. Objects are never rewritten, and one stays
+            until the script has been replaced twice, so a check started from
+            it is not pulled from under it by the next refresh.
+        """
+        with self.index_lock:
+            entry = self.index.get(name)
+        if entry is None:
+            return None
+        path = os.path.join(self.objects, entry['hash'])
+        return path if os.path.exists(path) else None
+
+    def installed(self, name):
+        """
+            Index entry of the script we have under `name`, None if we don't have it.
+        """
+        with self.index_lock:
+            entry = self.index.get(name)
+        if entry is not None and os.path.exists(self.script_path(name)):
+            return entry
+        return None
+
+    def fetch(self, url, name, rwlock, revalidate=False):
+        """
+            Make sure tmp/<name> holds the current version of the script at `url`.
+
+            Without `revalidate` an existing script is used as is. With it the
+            checks-repo is asked whether the script changed since we got it.
+            `rwlock` is only held (exclusively) for the final rename.
+
+            Returns the hash of the script in use.
+        """
+        entry = self.installed(name)
+        if revalidate:
+            return self.download(url, name, rwlock, entry)
+        if entry is not None:
+            return entry['hash']
+
+        # A check and the prefetch (or two checks) wanting the same new
+        # script download it once, the second one waits for the first.
+        with self.index_lock:
+            download_lock = self.download_locks.setdefault(name, Lock())
+
+        with download_lock:
+            entry = self.installed(name)
+            if entry is not None:
+                return entry['hash']
+            return self.download(url, name, rwlock, None)
+
+    def download(self, url, name, rwlock, entry):
+        """
+            GET the script at `url` into tmp/<name>, conditional on `entry`
+            (the index entry of the version we have) if there is one.
+        """
+        path = self.script_path(name)
+        installed = entry is not None
+
+        headers = {}
+        if installed:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last-modified'):
+                headers['If-Modified-Since'] = entry['last-modified']
+
+        with SCRIPT_DOWNLOAD.time():
+            chrsp = self.get_session().get(url, headers=headers, timeout=30)
+
+        if chrsp.status_code == 304 and installed:
+            return entry['hash']
+
+        chrsp.raise_for_status()
+
+        digest = hashlib.sha256(chrsp.content).hexdigest()
+        object_path = os.path.join(self.objects, digest)
+        if not os.path.exists(object_path):
+            self.atomic_write(object_path, chrsp.content)
+
+        # Link the object next to its final name, then swap it in.
+        # The link name is our own, two checks fetching the same new script
+        # at once each swap in their link.
+        link_path = f"{path}.{digest}.{os.getpid()}.{get_ident()}.part"
+        try:
+            os.link(object_path, link_path)
+        except FileNotFoundError:
+            # Another script dropped the same version in between.
+            self.atomic_write(object_path, chrsp.content)
+            os.link(object_path, link_path)
+
+        with rwlock.write():
+            os.replace(link_path, path)
+
+        with self.index_lock:
+            # The version we replaced becomes the previous one, the one
+            # before that is removed unless another script uses it.
+            old = self.index.get(name) or {}
+            dropped = None
+            previous = old.get('previous')
+            if old.get('hash') != digest:
+                dropped = previous
+                previous = old.get('hash')
+
+            self.index[name] = {'hash': digest,
+                                'previous': previous,
+                                'etag': chrsp.headers.get('ETag'),
+                                'last-modified': chrsp.headers.get('Last-Modified')}
+            self.save_index()
+
+            if dropped and dropped not in self.referenced():
+                self.remove_object(dropped)
+
+        return digest
+
+
+# Links in the checks-repo's nginx autoindex page.
+AUTOINDEX_HREF = re.compile(r'<a href="([^"]+)"')
+
+
+def autoindex_scripts(page):
+    """
+        Names of the files listed in an autoindex page, without the
+        parent link and subdirectories. They are kept as they appear in the
+        link, the same way a check's downloadURL names its script.
+    """
+    return [href for href in AUTOINDEX_HREF.findall(page)
+            if not href.startswith(("?", ".")) and "/" not in href]
+
+
+class BoundedCapture:
+    """
+        Keeps at most `max_bytes` of a stream: the first half and the last
+        half of what was written, whatever the stream's total size. The
+        SHA-256 of everything written is kept too if `digest` is set.
+    """
+    # Chunk size used when reading pipes and files into a capture.
+    CHUNK = 65536
+
+    def __init__(self, max_bytes, digest=False):
+        self.head_limit = max_bytes // 2
+        self.tail_limit = max_bytes - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.hash = hashlib.sha256() if digest else None
+
+    def feed(self, chunk):
+        self.total += len(chunk)
+        if self.hash is not None:
+            self.hash.update(chunk)
+
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+
+        if chunk:
+            self.tail += chunk
+            if len(self.tail) > self.tail_limit:
+                del self.tail[:len(self.tail) - self.tail_limit]
+
+    def drain(self, stream):
+        """
+            Feed everything from a binary stream until EOF.
+        """
+        for chunk in iter(lambda: stream.read1(self.CHUNK), b""):
+            self.feed(chunk)
+
+    def result(self):
+        """
+            {'data': bytes kept, 'bytes': total size, 'truncated': bool, 'sha256': hex or None}
+        """
+        kept = len(self.head) + len(self.tail)
+        truncated = self.total > kept
+        data = bytes(self.head)
+        if truncated:
+            data += f"\n...[{self.total - kept} bytes truncated]...\n".encode("utf-8")
+        data += bytes(self.tail)
+
+        return {'data': data,
+                'bytes': self.total,
+                'truncated': truncated,
+                'sha256': self.hash.hexdigest() if self.hash is not None else None}
+
+
+def warm_worker(conn):
+    """
+        Main loop of a warm interpreter (see WarmPythonPool).
+
+        Receives (script, argv, (max_bytes, digest)) jobs on `conn`, runs
+        the script in this process as if it was `python3 script argv...` and
+        sends back (exit code, stdout capture, stderr capture), see BoundedCapture.
+    """
+    # Own process group so the pool can kill us along with anything a check spawns.
+    os.setsid()
+
+    while True:
+        try:
+            script, argv, capture_args = conn.recv()
+        except EOFError:
+            return
+
+        conn.send(run_script_in_process(script, argv, capture_args))
+
+
+def run_script_in_process(script, argv, capture_args):
+    """
+        Run a Python script in the current interpreter, capturing what it
+        writes to stdout and stderr (at the file descriptor level, so output
+        of child processes it starts is captured too) and its exit code.
+
+        The output goes to temporary files and only a BoundedCapture of
+        each is sent back.
+    """
+    saved_argv = sys.argv
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+
+    with tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as err_file:
+        os.dup2(out_file.fileno(), 1)
+        os.dup2(err_file.fileno(), 2)
+        try:
+            sys.argv = [script] + argv
+            runpy.run_path(script, run_name="__main__")
+            rc = 0
+        except SystemExit as e:
+            if e.code is None:
+                rc = 0
+            elif isinstance(e.code, int):
+                rc = e.code
+            else:
+                # sys.exit("message") prints the message and exits with 1
+                print(e.code, file=sys.stderr)
+                rc = 1
+        except BaseException:
+            traceback.print_exc()
+            rc = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+            sys.argv = saved_argv
+
+        captures = []
+        for f in (out_file, err_file):
+            f.seek(0)
+            capture = BoundedCapture(*capture_args)
+            capture.drain(f)
+            captures.append(capture.result())
+
+        return rc, captures[0], captures[1]
+
+
+class WarmPythonPool:
+    """
+        Pool of Python interpreters that are already running, with the
+        common check libraries already imported, to run Python checks in.
+
+        Starting `python3` and importing paramiko/ssl/requests often takes
+        longer than the check itself. The workers are forked from a
+        multiprocessing forkserver that imported `warm_imports` once, a
+        check then costs a pipe round trip.
+
+        A worker is replaced after `max_runs` checks (checks share the
+        interpreter so state can leak between them), when it dies, or when
+        a check run in it times out.
+    """
+    def __init__(self, size, max_runs, warm_imports):
+        self.max_runs = max_runs
+
+        self.ctx = multiprocessing.get_context("forkserver")
+        # '__main__' so the forkserver imports this file once instead of every worker doing it.
+        self.ctx.set_forkserver_preload(['__main__'] + list(warm_imports))
+
+        # Workers waiting for a check, (process, connection, runs) tuples.
+        self.idle = queue.Queue()
+        for i in range(size):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=warm_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return (process, parent_conn, 0)
+
+    def retire(self, process, conn):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        process.join()
+        conn.close()
+
+    def run(self, script, argv, timeout, capture_args):
+        """
+            Run `script` with `argv` in a warm worker.
+
+            Returns (exit code, stdout capture, stderr capture, timed out).
+        """
+        process, conn, runs = self.idle.get()
+        timed_out = False
+        try:
+            conn.send((script, argv, capture_args))
+            if conn.poll(timeout):
+                rc, output, errors = conn.recv()
+                runs += 1
+            else:
+                timed_out = True
+                rc = TIMEOUT_EXIT_CODE
+                output = errors = BoundedCapture(*capture_args).result()
+        except (EOFError, OSError):
+            # The check took the interpreter down with it.
+            rc = process.exitcode if process.exitcode is not None else 1
+            output = errors = BoundedCapture(*capture_args).result()
+            runs = self.max_runs
+
+        if timed_out or runs >= self.max_runs or not process.is_alive():
+            self.retire(process, conn)
+            self.idle.put(self.spawn())
+        else:
+            self.idle.put((process, conn, runs))
+
+        return rc, output, errors, timed_out
+
+
+class CheckRunner:
+    """
+        Starts check scripts written for one run-method as
+        `<interpreter> <flags> <script> <args>`.
+
+        The interpreter's path and the environment are looked up once,
+        not on every check.
+    """
+    def __init__(self, interpreter, flags=()):
+        self.path = shutil.which(interpreter)
+        self.flags = list(flags)
+        self.env = os.environ.copy()
+
+    def available(self):
+        return self.path is not None
+
+    def run(self, agent, command, script, args, timeout):
+        """
+            Returns (exit code, stdout capture, stderr capture, timed out).
+        """
+        return agent.run_subprocess(command, [self.path] + self.flags + [script] + args, timeout, self.env)
+
+
+class PythonRunner(CheckRunner):
+    """
+        Python checks run with the agent's own interpreter (the pipenv one,
+        which has the check libraries), or in the warm pool when enabled.
+    """
+    def __init__(self):
+        super().__init__(sys.executable)
+
+    def run(self, agent, command, script, args, timeout):
+        if agent.python_pool is None:
+            return super().run(agent, command, script, args, timeout)
+
+        # Run it in an interpreter that is already up. The object of the
+        # version in use (tmp/objects/<sha256>) never changes, so the worker
+        # runs that and we don't hold the script's lock for the whole run,
+        # which would hold up a refresh and with it the MQTT thread.
+        # The check sees the object's path as sys.argv[0] and __file__.
+        object_path = agent.scripts.object_path(command)
+        if object_path is not None:
+            return agent.python_pool.run(object_path, args, timeout, agent.capture_args())
+
+        with agent.script_locks.get(command).read():
+            return agent.python_pool.run(script, args, timeout, agent.capture_args())
+
+
+# run-method (as sent by publish_checks) -> how to build its runner.
+RUN_METHODS = {
+    'python':  PythonRunner,
+    'python3': PythonRunner,
+    'bash':    lambda: CheckRunner('bash'),
+    'sh':      lambda: CheckRunner('sh'),
+    'ps1':     lambda: CheckRunner('pwsh', ['-NoProfile', '-NonInteractive', '-File']),
+}
+
+# Checks that don't say how to run them are Python, like they always were.
+DEFAULT_RUN_METHOD = 'python'
+
+
+# Payload encodings. json is the UTF-8 JSON document, msgpack a marker byte
+# followed by the msgpack document, zlib compressed when it is longer than
+# COMPRESS_THRESHOLD. A JSON document never starts with a marker byte, so
+# payloads are decoded whatever the sender picked.
+PAYLOAD_FORMATS = ("json", "msgpack")
+MSGPACK = b"\x01"
+MSGPACK_ZLIB = b"\x02"
+COMPRESS_THRESHOLD = 1024
+
+
+def encode_payload(obj, payload_format="json"):
+    """
+        `obj` as a payload in `payload_format`, JSON if msgpack is not installed.
+
+        Keep in sync with the API agent's payloads.py.
+    """
+    if payload_format == "msgpack" and msgpack is not None:
+        packed = msgpack.packb(obj)
+        if len(packed) > COMPRESS_THRESHOLD:
+            compressed = zlib.compress(packed)
+            if len(compressed) < len(packed):
+                return MSGPACK_ZLIB + compressed
+        return MSGPACK + packed
+
+    return json.dumps(obj).encode("utf-8")
+
+
+def decode_payload(payload):
+    """
+        The document in a payload of any of the PAYLOAD_FORMATS.
+
+        Keep in sync with the API agent's payloads.py.
+    """
+    marker = payload[:1]
+    if marker not in (MSGPACK, MSGPACK_ZLIB):
+        return json.loads(payload)
+
+    if msgpack is None:
+        raise ValueError("msgpack payload received but msgpack is not installed")
+
+    packed = payload[1:]
+    if marker == MSGPACK_ZLIB:
+        packed = zlib.decompress(packed)
+    return msgpack.unpackb(packed)
+
+
+# Every result topic is RESULT_TOPIC_PREFIX/<2 hex>/<32 hex>, see result_topic.
+RESULT_TOPIC_PREFIX = "result"
+
+
+def result_topic(agent, check, args):
+    """
+        The topic the result of `check` for `agent`, run with the arguments
+        `args` (joined by single spaces), is published to.
+
+        (agent, check, args) is encoded as a JSON array and hashed, so any
+        name or argument gets a topic of the same length and the API can
+        tell which result it is from the payload.
+
+        Keep in sync with result_key/result_topic in the API agent's result_cache.py.
+    """
+    canonical = json.dumps([agent, check, args], separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+    return f"{RESULT_TOPIC_PREFIX}/{digest[:2]}/{digest}"
+
+
+class ResultBatcher:
+    """
+        Collects check results for `window` seconds and publishes them as
+        one zlib compressed message instead of one retained message each.
+
+        The batch goes (retained) to `<topic>/<hostname>` as
+            {"version": 1, "results": [{"topic": <result topic>, "result": <result>}, ...]}
+        the API agent unpacks it into the same results it would have read
+        from the individual topics. With the json payload format that is
+        zlib compressed JSON, otherwise it is encoded like any other payload.
+    """
+    VERSION = 1
+
+    def __init__(self, mqttc, topic, window, payload_format="json"):
+        self.mqttc = mqttc
+        self.topic = f"{topic}/{socket.gethostname()}"
+        self.window = window
+        self.payload_format = payload_format
+
+        self.lock = Lock()
+        self.pending = []
+        self.timer = None
+
+    def add(self, topic, result):
+        with self.lock:
+            self.pending.append({'topic': topic, 'result': result})
+
+            # First result of a round opens the window.
+            if self.timer is None:
+                self.timer = Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            self.timer = None
+
+        if not pending:
+            return
+
+        batch = {'version': self.VERSION, 'results': pending}
+        if self.payload_format == "json":
+            payload = zlib.compress(json.dumps(batch).encode("utf-8"))
+        else:
+            payload = encode_payload(batch, self.payload_format)
+        logger.info("Publishing %s results to %s (%s bytes)", len(pending), self.topic, len(payload))
+        self.mqttc.publish(self.topic, payload, qos=1, retain=True)
 
-# add formatter to ch
-ch.setFormatter(formatter)
 
-# add ch to logger
-logger.addHandler(ch)
+class CheckExecutor:
+    """
+        Bounded pool of threads the checks run on.
+
+        At most `limit_for(command)` copies of a check script run at once,
+        the ones over the limit wait until a copy finishes. Waiting checks
+        are started oldest first, whatever their script.
+
+        A check is refused (and reported through `report`) instead of
+        queued when:
+            - the same check for the same agent and arguments is already
+              queued or running (coalesced, the running one will publish
+              the result anyway),
+            - `queue_depth` checks are already waiting (shed).
+    """
+    def __init__(self, workers, queue_depth, default_limit, check_limits, report):
+        self.queue_depth = queue_depth
+        self.default_limit = default_limit
+        self.check_limits = check_limits
+
+        # Called as report(event, command, arglist, agent) when a check is refused.
+        self.report = report
+
+        # Protects everything below, workers wait on it for a check they may start.
+        self.cond = Condition(Lock())
+
+        # command -> deque of checks waiting to run, oldest first.
+        self.pending = {}
+        self.waiting = 0
+
+        # Submission order, to start the oldest check that may run.
+        self.order = itertools.count()
+
+        # (agent, command, args) of every queued or running check.
+        self.in_flight = set()
+
+        # command -> number of running checks.
+        self.running = {}
+
+        CHECKS_QUEUED.set_function(self.depth)
+
+        for i in range(workers):
+            Thread(target=self.worker, name=f"check-worker-{i}", daemon=True).start()
+
+    def limit_for(self, command):
+        return self.check_limits.get(command, self.default_limit)
+
+    def submit(self, target, command, arglist, agent, **kwargs):
+        """
+            Queue `target(command, arglist, agent, **kwargs)` to run on a worker.
+
+            Returns False if the check was refused.
+        """
+        key = (agent, command, tuple(arglist))
+
+        with self.cond:
+            if key in self.in_flight:
+                event = "coalesced"
+            elif self.waiting >= self.queue_depth:
+                event = "shed"
+            else:
+                event = None
+                self.in_flight.add(key)
+                self.pending.setdefault(command, collections.deque()).append(
+                    (next(self.order), key, time.monotonic(), target, command, arglist, agent, kwargs))
+                self.waiting += 1
+                self.cond.notify()
+
+        if event is not None:
+            CHECKS_REFUSED.labels(event).inc()
+            self.report(event, command, arglist, agent)
+            return False
+
+        return True
+
+    def next_job(self):
+        # Caller holds self.cond. The oldest waiting check whose script is
+        # under its limit, None if there is none.
+        best = None
+        for command, jobs in self.pending.items():
+            if self.running.get(command, 0) < self.limit_for(command) and (best is None or jobs[0][0] < best[0][0]):
+                best = jobs
+
+        if best is None:
+            return None
+
+        job = best.popleft()
+        command = job[4]
+        if not best:
+            del self.pending[command]
+        self.waiting -= 1
+        self.running[command] = self.running.get(command, 0) + 1
+        return job
+
+    def worker(self):
+        while True:
+            with self.cond:
+                job = self.next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self.next_job()
+
+            order, key, queued_at, target, command, arglist, agent, kwargs = job
+            CHECK_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+            try:
+                with CHECKS_IN_FLIGHT.track_inprogress():
+                    target(command, arglist, agent, **kwargs)
+            except Exception as e:
+                logger.error("Unhandled error running %s: %s", command, e)
+            finally:
+                with self.cond:
+                    self.in_flight.discard(key)
+                    self.running[command] -= 1
+                    if self.running[command] == 0:
+                        del self.running[command]
+
+                    # A check of this script may be waiting for the slot.
+                    if command in self.pending:
+                        self.cond.notify()
+
+    def depth(self):
+        """
+            Number of checks waiting for a worker or for their script's limit.
+        """
+        return self.waiting
 
 
 class Agent:
@@ -44,14 +1002,19 @@ class Agent:
     def __init__(self):
 
         # Array to contains DNS associations.
+        # These are the names we found to resolve to this host.
         self.dns_associations = []
 
-        # Mutex List for refreshing topics
-        self.mut_list = []
-        # List of checks, we add to it when we
-        # see a new check, the idex allows us to
-        # associate a mutex with the
-        self.chk_list = []
+        # Ownership table, name -> True if the name resolves to us.
+        # Every agent sees every check so this is consulted for each message,
+        # it is kept up to date by a background thread (see refresh_ownership)
+        # so the message path does not go to the network.
+        self.ownership = {}
+
+        # Locks for the check scripts, keyed by script name.
+        # Running a check takes its script's lock shared, refreshing the
+        # script takes it exclusively.
+        self.script_locks = LockRegistry()
 
         # Init MQTT client object
         self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2) # Use Version2 for most up-to-date paho-mqtt clients, bettwen with MQTTv3 and 5
@@ -65,17 +1028,116 @@ class Agent:
         # Setup agent configuration and association
         self.read_agent_configuration()
 
+        # Checks for other agents, logged only now and then.
+        self.skipped_log = SampledLog(self.log_sample_interval)
+
+        self.dns_cache = DNSCache(self.dns_server, self.dns_negative_ttl)
+
+        # Our own address only changes if the network does, look it up once
+        # and let the refresh thread keep it current.
+        self.ip_address = self.get_ip_addresses()
+
+        # Started by run() when python_execution is "warm".
+        self.python_pool = None
+
+        # Whether on_connect ran before, the next time is a reconnect.
+        self.connected_before = False
+
+        # Results go out one message per round instead of one per check if enabled.
+        self.batcher = None
+        if self.result_batch_window > 0:
+            self.batcher = ResultBatcher(self.mqttc, self.result_batch_topic, self.result_batch_window, self.payload_format)
+
+        # Every result carries this run's id and a sequence number so the API
+        # can order the results of one run without trusting our clock.
+        self.run_id = uuid.uuid4().hex
+        self.result_seq = itertools.count(1)
+
+        # One runner per run-method, interpreters are resolved here once.
+        self.runners = {name: factory() for name, factory in RUN_METHODS.items()}
+
+        # Local copies of the check scripts.
+        self.scripts = ScriptCache("./tmp/", pool_size=self.executor_workers)
+
+        # Whether the script catalog prefetch was started, see prefetch_scripts.
+        self.prefetch_started = False
+
+        # Checks run on a fixed number of threads, never one thread per message.
+        self.executor = CheckExecutor(self.executor_workers,
+                                      self.executor_queue_depth,
+                                      self.check_concurrency_limit,
+                                      self.check_concurrency_limits,
+                                      self.report_executor_event)
+
     def run(self):
         """
             Run the agent. This is what will carry out all the functions.
         """
 
-        # Connect, Subscriptions are made on connection
+        # Connect first, Subscriptions are made on connection.
+        # Everything else comes up in the background while the first
+        # checks arrive.
         self.mqttc.connect(self.mqtt_broker, self.mqtt_port)
 
+        # Keep the ownership table fresh in the background.
+        Thread(target=self.refresh_ownership, daemon=True).start()
+
+        # Get every check script before the first round asks for it.
+        if self.prefetch and self.checks_repo_url:
+            self.start_prefetch(self.checks_repo_url)
+
+        # Interpreters for Python checks, if enabled.
+        # Until they are up Python checks start their own interpreter.
+        if self.python_execution == 'warm':
+            Thread(target=self.start_python_pool, daemon=True).start()
+
+        # Metrics for whoever wants them.
+        if self.metrics_port:
+            prometheus_client.start_http_server(self.metrics_port, addr=self.metrics_address)
+        if self.metrics_topic:
+            Thread(target=self.publish_metrics, daemon=True).start()
+
         # Loop Forever
         self.mqttc.loop_forever()
 
+    def start_python_pool(self):
+        self.python_pool = WarmPythonPool(self.warm_pool_size, self.warm_pool_max_runs, self.warm_pool_imports)
+
+    def start_prefetch(self, repo_url):
+        # Called from run() or the MQTT thread, only ever once.
+        if self.prefetch_started:
+            return
+        self.prefetch_started = True
+        Thread(target=self.prefetch_scripts, args=(repo_url,), daemon=True).start()
+
+    def prefetch_scripts(self, repo_url):
+        """
+            Download every script the checks-repo lists at `repo_url` into the
+            script cache, prefetch_workers at a time. Scripts we already have
+            are left alone, refresh messages keep those current.
+        """
+        started = time.monotonic()
+        try:
+            listing = self.scripts.get_session().get(repo_url, timeout=30)
+            listing.raise_for_status()
+            names = autoindex_scripts(listing.text)
+        except Exception as e:
+            logger.warning("Could not list the check scripts at %s: %s", repo_url, e)
+            return
+
+        def fetch(name):
+            try:
+                self.scripts.fetch(urllib.parse.urljoin(repo_url, name), name, self.script_locks.get(name))
+                return True
+            except Exception as e:
+                logger.warning("Error prefetching %s: %s", name, e)
+                return False
+
+        with ThreadPoolExecutor(self.prefetch_workers, thread_name_prefix="prefetch") as pool:
+            fetched = sum(pool.map(fetch, names))
+
+        logger.info("Prefetched %s of %s check scripts from %s in %.2fs", fetched, len(names), repo_url, time.monotonic() - started)
+
     def on_subscribe(self,client, userdata, mid, reason_code_list, properties):
         """
         Callback function for paho-MQTT when subscribing to a topic.
@@ -89,9 +1151,9 @@ class Agent:
             # If the responce is a failure, we have a large problem.
             # Should probably add logging at some point -- Matt
             if responce.is_failure:
-                logger.error(f"Broker rejected your subscription: {responce}")
+                logger.error("Broker rejected your subscription: %s", responce)
             else:
-                logger.info(f"Broker granted the following QoS level: {responce.value}")
+                logger.info("Broker granted the following QoS level: %s", responce.value)
         return
 
     def on_unsubscribe(self, client, userdata, mid, reason_code_list, properties):
@@ -120,7 +1182,7 @@ class Agent:
             if  not responce.is_failure:
                 logger.info("unsubscribe succeeded (if SUBACK is received in MQTTv3 it is a success)")
             else:
-                logger.error(f"Broker replied with failure: {reason}")
+                logger.error("Broker replied with failure: %s", reason)
 
         # We are done, so we should exit!
         self.client.disconnect()
@@ -131,7 +1193,7 @@ class Agent:
         This is the callback function which is done every time the client connects to the MQTT server
         """
         if reason_code.is_failure:
-            logger.error(f"Failed to connect: {reason_code}. The loop_forever() function will retry connection")
+            logger.error("Failed to connect: %s. The loop_forever() function will retry connection", reason_code)
             return
 
         # we should always subscribe from on_connect callback to be sure
@@ -139,6 +1201,9 @@ class Agent:
         for topic in self.sub_topic_list:
             client.subscribe(topic)
 
+        if self.connected_before:
+            MQTT_RECONNECTS.inc()
+        self.connected_before = True
 
     def on_message(self, client, userdata, message):
         """
@@ -152,30 +1217,15 @@ class Agent:
 
             # Load JSON message into python dictionary
             try:
-                jmessage = json.loads(message.payload.decode('utf8'))
+                jmessage = decode_payload(message.payload)
 
                 # Reverse DNS lookup did not work with PiHole.
-                # Need to do a forward lookup each time there is a new check that comes in.
-                # We're not worried about performance at the moment.
-                # Potential scalability issue.
-
-                my_resolver = dns.resolver.Resolver()
-                my_resolver.nameservers = [self.dns_server]  #set name servers seperated by comma
-                ipaddy = jmessage['agent']
-
-                try:
-                    result = my_resolver.resolve(ipaddy, "A")[0]
-                except Exception as e:
-                    logger.info(f"DNS not for me... ignore this check")
-                    return
-
-                # Get the IP addresses that are associated with this host.
-                ip_address = self.get_ip_addresses()
-                logger.info(ip_address)
-
-                # Check if my IP is in the answer.
-                if(ip_address != result.address):
-                    logger.info(f"Received message for {jmessage['agent']}: Skipping check at URL {jmessage['downloadURL']}")
+                # We do forward lookups instead, but only the first time we see a name,
+                # after that the answer comes from the ownership table.
+                # Routed checks were addressed to us by the broker, no need to look.
+                # Every agent gets every other agent's checks, only a sample of those is logged.
+                if message.topic not in self.routed_topic_list and not self.is_mine(jmessage['agent']):
+                    self.skipped_log.log(logging.INFO, "Received message for %s: Skipping check at URL %s", jmessage['agent'], jmessage['downloadURL'])
                     return
 
                 # Parse out Script name from URL (Last chunk?)
@@ -184,18 +1234,16 @@ class Agent:
                 # This is a failure case.
                 if sindex == -1:
                     self.agent_failure("Error Parsing out command name")
-                    logger.error(f"Error Parsing out command name from {jmessage['downloadURL']}")
+                    logger.error("Error Parsing out command name from %s", jmessage['downloadURL'])
                     return
 
                 # substr Out command Name from URL
                 commandName = (jmessage['downloadURL'])[sindex+1:]
 
-                # Mutual Exclusion Setup, we will use the index into chk_list to find the correct mutex...
-                # we only do this if it has not been done before.
-                if commandName not in self.chk_list:
-                    self.mut_list.append(Lock())
-                    self.chk_list.append(commandName)
-
+                # Without a checks_repo_url the scripts are prefetched from
+                # wherever the first check says they are.
+                if self.prefetch and not self.prefetch_started:
+                    self.start_prefetch(jmessage['downloadURL'][:sindex+1])
 
                 # If this is a check we need to handle check based operations
                 if jmessage['msgtype'] == self.check_type_name:
@@ -204,19 +1252,19 @@ class Agent:
                     # it should immediately return a success if they already exist
                     if (self.download_check_script(jmessage['downloadURL'], commandName) == -1):
                         self.agent_failure("Error in downloading script")
-                        logger.error(f"Error in downloading script: {jmessage['downloadURL']}")
+                        logger.error("Error in downloading script: %s", jmessage['downloadURL'])
                         return
 
                     # We run the check... This will internally parse the check's file name
                     # This function will handle updating the responce to the MQTT server too
-                    self.run_check_script(commandName, jmessage['arg-list'], jmessage['agent'])
+                    self.run_check_script(commandName, jmessage['arg-list'], jmessage['agent'], jmessage.get('timeout'), jmessage.get('run-method'))
 
                 # If this is a refresh message we need to handle refresh (of file) operations
                 elif jmessage['msgtype'] == self.refresh_type_name:
 
                     if (self.refresh_check_script(jmessage['downloadURL'], commandName) == -1):
                         self.agent_failure("Failure to refresh script")
-                        logger.error(f"Error in refreshing script: {jmessage['downloadURL']}")
+                        logger.error("Error in refreshing script: %s", jmessage['downloadURL'])
 
                     return
 
@@ -228,56 +1276,89 @@ class Agent:
         else:
             # This should not be possible but we should take care
             self.agent_failure("Unknown message topic received")
-            logger.error(f"Unknown topic received: {message.topic}")
+            logger.error("Unknown topic received: %s", message.topic)
             return
 
     def refresh_check_script(self, checkURL, commandName):
+        """
+            Revalidate the check script against the checks-repo and swap in
+            the new version if it changed.
+        """
         res = 0
-        # Claim mutex to prevent overwriting files while in use
-        with self.mut_list[self.chk_list.index(commandName)]:
-            try:
-                # Setup Directory
-                if(not os.path.exists("./tmp/")):
-                    os.mkdir("tmp/")
-
-                chrsp = requests.get(checkURL)
-
-                with open("./tmp/"+commandName, "wb") as f:
-                    f.write(chrsp.content)
-            except Exception as e:
-                res = -1
+        try:
+            # The lock is only claimed to swap the file, not while downloading.
+            self.scripts.fetch(checkURL, commandName, self.script_locks.get(commandName), revalidate=True)
+        except Exception as e:
+            logger.error("Error refreshing %s: %s", commandName, e)
+            res = -1
         return res
 
     def download_check_script(self, checkURL, commandName):
         """
             Download the check script that is associated with the check.
 
-            Likely going to be a get request.
+            Returns immediately if we already have it.
         """
         res = 0
         # Refresh would be handled elsewhere we just need to make
         # sure we do not start messing with the files while they are
         # being executed
+        try:
+            self.scripts.fetch(checkURL, commandName, self.script_locks.get(commandName))
+        except Exception as e:
+            logger.error("Error downloading %s: %s", commandName, e)
+            res = -1
+        return res
 
-        # Claim Mutex for function?
-        with self.mut_list[self.chk_list.index(commandName)]:
+    def is_mine(self, name):
+        """
+            Whether `name` resolves to this host.
 
-            try:
-                # Setup Directory
-                if(not os.path.exists("./tmp/")):
-                    os.mkdir("tmp/")
+            This is a dictionary lookup for any name we have seen before, only
+            a never seen name costs a DNS query.
+        """
+        owned = self.ownership.get(name)
+        if owned is None:
+            owned = self.ip_address in self.dns_cache.lookup(name)
+            self.update_ownership(name, owned)
+        return owned
 
-                # Get the check script from the check_repo.
-                # The check script will be a python script that will be run on the agent.
-                if not (os.path.exists("./tmp/"+commandName)):
-                    chrsp = requests.get(checkURL)
+    def update_ownership(self, name, owned):
+        """
+            Record whether `name` belongs to us.
+        """
+        self.ownership[name] = owned
+        if owned and name not in self.dns_associations:
+            self.dns_associations.append(name)
+            logger.info("%s resolves to this agent", name)
+        elif not owned and name in self.dns_associations:
+            self.dns_associations.remove(name)
+            logger.info("%s no longer resolves to this agent", name)
+
+    def refresh_ownership(self):
+        """
+            Background loop keeping the ownership table in line with DNS.
 
-                    with open("./tmp/"+commandName, "wb") as f:
-                        f.write(chrsp.content)
+            Every `dns_refresh_interval` seconds the names whose cached answer
+            expired are looked up again. Our own address is refreshed too in case
+            the host moved. Names from agent_names (routed mode) stay ours.
+        """
+        while True:
+            time.sleep(self.dns_refresh_interval)
+
+            try:
+                ip_address = self.get_ip_addresses()
+                ip_changed = ip_address != self.ip_address
+                self.ip_address = ip_address
+
+                # Copy, the message thread may add names while we walk it.
+                for name in list(self.ownership):
+                    if name in self.configured_names:
+                        continue
+                    if ip_changed or self.dns_cache.expired(name):
+                        self.update_ownership(name, ip_address in self.dns_cache.resolve(name))
             except Exception as e:
-                res = -1
-        # There is a better way.
-        return res
+                logger.error("Error refreshing the ownership table: %s", e)
 
     def get_ip_addresses(self):
         """
@@ -333,6 +1414,34 @@ class Agent:
             # We will find the 'check' topic's identifier at.
             self.check_topic_num = agent_config['check_topic_num']
 
+            # broadcast: checks for everyone arrive on the check topic and we filter them.
+            # routed:    the API publishes to "<check topic>/<agent name>", we only
+            #            subscribe to the names in agent_names.
+            # This must match CHECK_ROUTING on the API agent.
+            self.check_routing = agent_config.get('check_routing', 'broadcast')
+
+            # DNS names this agent answers checks for (e.g. 1-agent1), used in routed mode.
+            self.agent_names = agent_config.get('agent_names', [])
+
+            # Topics carrying checks that were routed to us.
+            self.routed_topic_list = []
+
+            # Names that are ours by configuration, DNS has no say over them.
+            self.configured_names = set()
+
+            if self.check_routing == 'routed':
+                check_topic = self.sub_topic_list[self.check_topic_num]
+                self.routed_topic_list = [f"{check_topic}/{name}" for name in self.agent_names]
+
+                # Swap the broadcast topic for one topic per name we own.
+                self.sub_topic_list = [topic for topic in self.sub_topic_list if topic != check_topic]
+                self.sub_topic_list.extend(self.routed_topic_list)
+
+                # These names are ours by configuration.
+                self.configured_names = set(self.agent_names)
+                for name in self.agent_names:
+                    self.update_ownership(name, True)
+
             # This is a list of topics that we should
             # Publish to.
             self.pub_topic_list = agent_config['mqtt_pub_topic_list']
@@ -344,8 +1453,83 @@ class Agent:
             # Get the location of the blue team DNS server.
             self.dns_server = agent_config['dns_server']
 
-    def run_check_thread(self, command, arglist, agent):
-        logger.info("Reached run_check_thread")
+            # How long (seconds) to remember that a name does not resolve.
+            self.dns_negative_ttl = int(agent_config.get('dns_negative_ttl', 30))
+
+            # How often (seconds) the ownership table is checked against DNS.
+            self.dns_refresh_interval = int(agent_config.get('dns_refresh_interval', 15))
+
+            # Number of threads running checks.
+            self.executor_workers = int(agent_config.get('executor_workers', 8))
+
+            # Checks allowed to wait (for a free worker or their script's
+            # limit) before new ones are shed.
+            self.executor_queue_depth = int(agent_config.get('executor_queue_depth', 64))
+
+            # Running copies allowed of any one check script, more wait their turn.
+            # check_concurrency_limits overrides it per script name.
+            self.check_concurrency_limit = int(agent_config.get('check_concurrency_limit', 4))
+            self.check_concurrency_limits = {name: int(limit) for name, limit in agent_config.get('check_concurrency_limits', {}).items()}
+
+            # Seconds a check may run before its process group is killed,
+            # unless the check message says otherwise.
+            self.check_timeout = float(agent_config.get('check_timeout', 30))
+
+            # subprocess: every Python check starts a new python3.
+            # warm:       Python checks run in a pool of already started interpreters.
+            self.python_execution = agent_config.get('python_execution', 'subprocess')
+
+            # Warm interpreters to keep, and how many checks each runs before it is replaced.
+            self.warm_pool_size = int(agent_config.get('warm_pool_size', self.executor_workers))
+            self.warm_pool_max_runs = int(agent_config.get('warm_pool_max_runs', 50))
+
+            # Modules imported once by the warm interpreters, missing ones are skipped.
+            self.warm_pool_imports = agent_config.get('warm_pool_imports', ['socket', 'ssl', 'json', 'requests', 'paramiko'])
+
+            # Bytes of a check's stdout (and, separately, stderr) kept for the result,
+            # longer output keeps its first and last half of this.
+            self.output_max_bytes = int(agent_config.get('output_max_bytes', 16384))
+
+            # Include the SHA-256 of the full output in the result.
+            self.output_digest = bool(agent_config.get('output_digest', False))
+
+            # Seconds to collect results for before publishing them as one batch,
+            # 0 publishes every result on its own topic as it comes.
+            self.result_batch_window = float(agent_config.get('result_batch_window', 0))
+
+            # Batches are published to "<result_batch_topic>/<hostname>".
+            self.result_batch_topic = agent_config.get('result_batch_topic', 'batch-results')
+
+            # Encoding of our results, one of PAYLOAD_FORMATS. Checks are
+            # read in whatever format the API sends them.
+            self.payload_format = agent_config.get('payload_format', 'json')
+
+            # Port (0 for none) and address to serve the Prometheus metrics on.
+            self.metrics_port = int(agent_config.get('metrics_port', 0))
+            self.metrics_address = agent_config.get('metrics_address', '0.0.0.0')
+
+            # The metrics are also published retained to "<metrics_topic>/<hostname>"
+            # every metrics_interval seconds, "" for never.
+            self.metrics_topic = agent_config.get('metrics_topic', '')
+            self.metrics_interval = float(agent_config.get('metrics_interval', 15))
+
+            # Directory listing (nginx autoindex) of the checks-repo, e.g.
+            # http://10.0.0.5:8080/checks/. Every script in it is downloaded
+            # at startup when prefetch is on. If empty, the directory of the
+            # first check's downloadURL is used.
+            self.checks_repo_url = agent_config.get('checks_repo_url', '')
+            self.prefetch = bool(agent_config.get('prefetch_scripts', True))
+            self.prefetch_workers = int(agent_config.get('prefetch_workers', 4))
+
+            # DEBUG, INFO, WARNING, ...
+            logger.setLevel(agent_config.get('log_level', 'INFO'))
+
+            # Seconds between two logged messages of the high volume kind
+            # (checks meant for other agents).
+            self.log_sample_interval = float(agent_config.get('log_sample_interval', 10))
+
+    def run_check_thread(self, command, arglist, agent, timeout, runner):
+        logger.debug("Reached run_check_thread")
 
         try:
             true_arglist = copy.deepcopy(arglist)
@@ -356,52 +1540,219 @@ class Agent:
             for arg in true_arglist:
                 arglist.extend(arg.split())  # Split strings and add elements individually to arglist
 
-            # Create Subprocess and PIPE for communcation
-            arglist.insert(0,"tmp/"+command)
-            arglist.insert(0,"python3") # Hodge Podge
+            with CHECK_RUNTIME.labels(command).time():
+                check_rc, check_output, check_errors, timed_out = runner.run(self, command, "tmp/"+command, arglist, timeout)
 
-            check_process = subprocess.Popen(arglist, stdout=subprocess.PIPE) # May need to invoke Python Interpriter
+            check_data = check_output['data'].decode("utf-8", errors="replace")
 
-            # Parse Results and Create message
-            check_data = (check_process.communicate()[0]).decode("utf-8")
-            check_rc = check_process.returncode
+            if timed_out:
+                logger.warning("Check %s for %s timed out after %s seconds", command, agent, timeout)
+                check_rc = TIMEOUT_EXIT_CODE
+                check_data = f"Check timed out after {timeout} seconds\n{check_data}"
+                CHECK_RESULTS.labels('timed-out').inc()
+            elif check_rc == 0:
+                CHECK_RESULTS.labels('passed').inc()
+            else:
+                CHECK_RESULTS.labels('failed').inc()
 
-            # Timestamp needed for the retain argument
-            now = str(datetime.datetime.now())
+            # Timestamp needed for the retain argument, milliseconds since the
+            # epoch so it means the same thing whatever our timezone is.
+            now = time.time_ns() // 1_000_000
 
             data = {'reporting-agent':agent,
                     'check-ran':command,
+                    'args': ' '.join(arglist),
                     'exit-code':check_rc,
                     'description': check_data,
-                    'timestamp': now}
-
-            msg = json.dumps(data)
+                    'description-bytes': check_output['bytes'],
+                    'description-truncated': check_output['truncated'],
+                    'stderr': check_errors['data'].decode("utf-8", errors="replace"),
+                    'stderr-bytes': check_errors['bytes'],
+                    'stderr-truncated': check_errors['truncated'],
+                    'timed-out': timed_out,
+                    'timestamp-ms': now,
+                    'agent-run': self.run_id,
+                    'seq': next(self.result_seq)}
+
+            if self.output_digest:
+                data['description-sha256'] = check_output['sha256']
+                data['stderr-sha256'] = check_errors['sha256']
+
+            msg = encode_payload(data, self.payload_format)
 
             # This will return a Message Info Class, I ignore this because there
             # is not much we can do if the message fails to send (ADD LOGGING)
             #self.mqttc.publish(self.pub_topic_list[self.pub_topic_num], msg, qos=1)
 
-            topic_to_publish_to = f"{agent}-{command}-{'-'.join(true_arglist[0].split())}-result"
-            logger.info(f"Publishing info to: {topic_to_publish_to}" )
-
+            topic_to_publish_to = result_topic(agent, command, data['args'])
+            logger.debug("Publishing info to: %s", topic_to_publish_to)
 
-            # logger.info(f"Publishing info to: {agent}-{command}-{'-'.join(true_arglist)}-result" )
-            # self.mqttc.publish(f"{agent}-{command}-{'-'.join(true_arglist)}-result", msg, qos=1, retain=True)
-            self.mqttc.publish(topic_to_publish_to, msg, qos=1, retain=True)
+            if self.batcher is not None:
+                self.batcher.add(topic_to_publish_to, data)
+            else:
+                self.mqttc.publish(topic_to_publish_to, msg, qos=1, retain=True)
 
         except Exception as e:
             self.agent_failure('Failure in running score check')
 
-    def run_check_script(self, command, arglist, agent):
+    def run_subprocess(self, command, arglist, timeout, env=None):
+        """
+            Run a check as its own process.
+
+            stdout and stderr are streamed into BoundedCaptures as the check
+            writes them, a chatty check can't grow the agent's memory.
+
+            `timeout` bounds the check process: only a check still running at
+            the deadline is reported as timed out. Once it exited, its pipes
+            are read for EXIT_OUTPUT_GRACE more seconds at most, a child that
+            left its process group and holds them open doesn't hold up the
+            result, the check's own exit code is reported.
+
+            Returns (exit code, stdout capture, stderr capture, timed out).
+        """
+        deadline = time.monotonic() + timeout
+
+        # New session so the check and anything it spawns share a process group we can kill.
+        # Hold the script's shared lock while starting it so a refresh can't swap
+        # the file in between, other runs of the same script go ahead in parallel.
+        with self.script_locks.get(command).read():
+            check_process = subprocess.Popen(arglist, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, env=env)
+
+        captures = {check_process.stdout: BoundedCapture(*self.capture_args()),
+                    check_process.stderr: BoundedCapture(*self.capture_args())}
+
+        # Read both pipes until they close, the deadline passes or the grace
+        # period after the check exited runs out.
+        # Whatever happens, the check doesn't outlive this.
+        timed_out = False
+        exited_at = None
+        try:
+            with selectors.DefaultSelector() as selector:
+                for stream in captures:
+                    selector.register(stream, selectors.EVENT_READ)
+
+                while selector.get_map():
+                    now = time.monotonic()
+
+                    # Don't let anything the check left running in the background
+                    # linger once it exited, it would keep the pipes open.
+                    if exited_at is None and check_process.poll() is not None:
+                        self.kill_check_group(check_process)
+                        exited_at = now
+
+                    if exited_at is None:
+                        remaining = deadline - now
+                    else:
+                        remaining = exited_at + EXIT_OUTPUT_GRACE - now
+
+                    if remaining <= 0:
+                        timed_out = exited_at is None
+                        break
+
+                    for key, events in selector.select(min(remaining, 0.1)):
+                        chunk = os.read(key.fd, BoundedCapture.CHUNK)
+                        if chunk:
+                            captures[key.fileobj].feed(chunk)
+                        else:
+                            selector.unregister(key.fileobj)
+
+            if not timed_out:
+                try:
+                    check_process.wait(timeout=max(deadline - time.monotonic(), 0))
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+        finally:
+            self.kill_check_group(check_process)
+            check_process.wait()
+            check_process.stdout.close()
+            check_process.stderr.close()
+
+        output, errors = captures.values()
+        return check_process.returncode, output.result(), errors.result(), timed_out
+
+    def capture_args(self):
+        """
+            BoundedCapture arguments for a check's output.
+        """
+        return (self.output_max_bytes, self.output_digest)
+
+    def kill_check_group(self, check_process):
+        """
+            Kill the process group of a check (the check and its children).
+        """
+        try:
+            os.killpg(check_process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # Already gone.
+            pass
+
+    def run_check_script(self, command, arglist, agent, timeout=None, run_method=None):
         """
             Run the script that was downloaded from the script-repo.
 
+            `timeout` comes from the check message, if it did not
+            set one the configured check_timeout is used.
+            `run_method` picks the runner from RUN_METHODS.
+        """
+
+        logger.debug("Reached run_check_script")
+
+        runner = self.runners.get(run_method or DEFAULT_RUN_METHOD)
+        if runner is None or not runner.available():
+            self.agent_failure(f"Can't run {command}: run-method {run_method} is not supported on this agent")
+            logger.error("Unsupported run-method %s for %s", run_method, command)
+            return
+
+        if timeout is None:
+            timeout = self.check_timeout
+        else:
+            try:
+                requested = float(timeout)
+            except (TypeError, ValueError):
+                requested = math.nan
+
+            # NaN, inf, 0 and negative timeouts would leave the check unbounded
+            # or time it out before it starts.
+            if not (math.isfinite(requested) and requested > 0):
+                logger.error("Invalid timeout %s for %s, using %s", timeout, command, self.check_timeout)
+                timeout = self.check_timeout
+            elif requested > MAX_CHECK_TIMEOUT:
+                logger.warning("Timeout %s for %s is too long, using %s", timeout, command, MAX_CHECK_TIMEOUT)
+                timeout = MAX_CHECK_TIMEOUT
+            else:
+                timeout = requested
+
+        self.executor.submit(self.run_check_thread, command, arglist, agent, timeout=timeout, runner=runner)
+
+    def publish_metrics(self):
+        """
+            Background loop publishing the metrics to the broker, for setups
+            that can't scrape the agents directly.
+        """
+        topic = f"{self.metrics_topic}/{socket.gethostname()}"
+        while True:
+            time.sleep(self.metrics_interval)
+            try:
+                self.mqttc.publish(topic, prometheus_client.generate_latest(), qos=0, retain=True)
+            except Exception as e:
+                logger.error("Error publishing metrics: %s", e)
+
+    def report_executor_event(self, event, command, arglist, agent):
+        """
+            Let the results topic know the executor refused a check,
+            so an overloaded agent shows up somewhere other than a missing result.
         """
+        logger.warning("Check %s %s for %s was %s (queue depth %s)", command, arglist, agent, event, self.executor.depth())
 
-        logger.info("Reached run_check_script")
+        msg = json.dumps({'reportingagent':self.dns_associations,
+                          'check-ran':command,
+                          'agent':agent,
+                          'arg-list':arglist,
+                          'event':event,
+                          'queue-depth':self.executor.depth(),
+                          'description':f"Check {event} by the agent executor"})
 
-        thread = Thread(target=self.run_check_thread, args=(command, arglist, agent), daemon=False)
-        thread.start()
+        self.mqttc.publish(self.pub_topic_list[self.pub_topic_num], msg, qos=1)
 
     def agent_failure(self, MSG):
         # Agent Failure
@@ -414,5 +1765,7 @@ class Agent:
 
 if __name__ == "__main__":
 
+    setup_logging()
+
     # Run the agent.
     Agent().run()
@@ -1,23 +1,27 @@
 from ast import literal_eval
 import json
 import logging
+import os
+import time
 from flask import Flask, request, Response, make_response, jsonify
 
-# Paho MQTT python library.
-from paho.mqtt.enums import MQTTProtocolVersion
-import paho.mqtt.publish as publish
-import paho.mqtt.client as mqtt
+from broker import CheckPublisher, ResultSubscriber
+from history import history_query
+from logs import setup_logging
+import metrics
+from result_cache import bulk_answer, bulk_status, parse_bulk_request, result_key, result_status, result_topic
 
-# Time imports needed to timeout the old MQTT messages
-import time
-import datetime
-import threading
-    
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
+# Configure logging, LOG_LEVEL=DEBUG shows every request's details.
+# Set up before shared.py so what it logs (loading the history) shows up.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+log_listener = setup_logging(LOG_LEVEL)
 
-# Timeout used to denote an old check.
-PUBLISH_REPORT_TIMEOUT = 45
+from shared import (API_PORT, API_SERVER_MODE, CHECK_ROUTING, MQTT_HOST, MQTT_MAX_INFLIGHT, MQTT_PORT,
+                    PUBLISH_CHECKS_TIMEOUT, READ_RESULT_WAIT, check_message_cache, history, results)
+
+# Flask mode's MQTT connections, made by main(). The async mode has its own.
+result_subscriber = None
+check_publisher = None
 
 app = Flask(__name__)
 
@@ -35,43 +39,30 @@ def publish_checks():
                 - target-agent: Who the check is reserved for (DNS name)
                 - target-script: Which check script to run
                 - arglist: List of extra arguments given.
+                - timeout: Seconds the agent lets the check run (optional)
             - repo-IP: <IP address>
             - run-method: [ python | bash | ps1 | sh ]            
+            - routing: [ broadcast | routed ] (optional, defaults to CHECK_ROUTING)
               
     """
     
-    # Now, parse out the information that was sent.
-    req = request.get_json()
-    print(f"Request: {req}")
-    
-    # Parse out the important information
-    list_of_checks = req.get('checks', [])
-    repo_ip = req.get('repo-ip', "")
-
-    # So now, we have all the information that we need to
-    # start publishing to the MQTT topic for checks.
-    
-    # Create an array to publish multiple messages at once.
-    # Multiple small json dictionaries that is.
-    messages = []
-    
-    for check in list_of_checks:
-        
-        # Convert the random bytes in here to a dictionary that can be parsed.
-        mqtt_data = {
-            "agent": check["target-agent"],
-            "downloadURL": f"http://{repo_ip}:8080/checks/{check["target-script"]}",
-            "msgtype": "check", # TODO: If it needs to be refreshed, then let everyone know.
-            "run-method": check['run-method'],
-            "arg-list": check['arg-list']
-        }
-        
-        mqtt_data = json.dumps(mqtt_data)
-        messages.append({'topic': "checks", 'payload': mqtt_data})
-
+    # Repeated bodies (every round) come straight from the cache,
+    # only a new or changed body is parsed and turned into messages.
+    try:
+        messages = check_message_cache.messages_for(request.get_data(), CHECK_ROUTING)
+    except ValueError as e:
+        logging.error("Bad /publish-checks request: %s", e)
+        return jsonify({"error": str(e)}), 400
 
     # Now, publish these checks.
-    publish.multiple(messages, hostname="mqtt-server", port=1883, protocol=MQTTProtocolVersion.MQTTv5)
+    metrics.publish_tracker.published(message['key'] for message in messages)
+    try:
+        with metrics.PUBLISH_CHECKS.time():
+            check_publisher.publish_all(messages, timeout=PUBLISH_CHECKS_TIMEOUT)
+    except TimeoutError as e:
+        logging.error("Failed to publish checks: %s", e)
+        return jsonify({"error": "Failed to publish checks"}), 500
+
     return Response("Checks have been published.", status=200)
     
 
@@ -95,88 +86,140 @@ def read_result():
     target_agent = req.get('reporting-agent')
     target_check = req.get('check-ran')
     arg_list = req.get('arg-list')
-    # target_topic = f'{target_agent}-{target_check}-{'-'.join(arg_list)}-result'
-
-    target_topic = f"{target_agent}-{target_check}-{'-'.join(arg_list[0].split())}-result"
-
 
-    logging.debug(f"Information contained within the request:\n"
-                 f"\tAgent looking for: {target_agent}\n"
-                 f"\tCheck supposed to run: {target_check}\n"
-                 f"\tTopic supposed to read from: {target_topic}") 
-    
-    if not target_topic or not target_agent or not target_check:
+    if not target_agent or not target_check or arg_list is None:
         logging.error("Missing required parameters in the request")
+        metrics.READ_RESULTS.labels(400).inc()
         return jsonify({"error": "Missing required parameters"}), 400
-    
-    result_event = threading.Event()
-    mqtt_message = {'description': None, 'status': None}
-
-    # Define the callback function for when a message is received
-    def on_message(client, userdata, message):
-        try:
-            message_payload = message.payload.decode('utf8')
-            # logging.info(f"Received MQTT message: {message_payload}")
-            json_message = json.loads(message_payload)
-        
-            # Get the last timestamp and check it against the current time.
-            last_timestamp = json_message['timestamp']
-            logging.debug(f"Timestamp included in the message: {last_timestamp}")
-
-            # Cast them to structs that can do arithmetic operations.
-            last_timestamp = time.mktime(datetime.datetime.strptime(last_timestamp, "%Y-%m-%d %H:%M:%S.%f").timetuple())
-            cur_timestamp = time.mktime(datetime.datetime.now().timetuple())
-            logging.debug(f"Time difference: {cur_timestamp - last_timestamp}")
-
-            if cur_timestamp - last_timestamp > PUBLISH_REPORT_TIMEOUT:
-                result_code = 406
-                mqtt_message['description']= "Old MQTT message detected. Is the target agent running?"
-                mqtt_message['status'] = result_code
-                logging.debug(f"Old MQTT message detected. Is the target agent running?")
-                result_event.set()
-            elif (json_message['reporting-agent'] == target_agent and json_message['check-ran'] == target_check):
-                result_code = 200 if json_message['exit-code'] == 0 else 406
-                mqtt_message['description'] = json_message['description']
-                mqtt_message['status'] = result_code
-                logging.debug(f"Setting result event with message: {mqtt_message}")
-                result_event.set()
-        except Exception as e:
-            logging.exception(f"Exception occurred in the on_message callback: {e}")
-        finally:
-            client.disconnect()
-
-    # Define the callback function for when the client connects to the broker
-    def on_connect(client, userdata, flags, reason_code, properties=None):
-        logging.info(f"Connected to MQTT broker with result code {reason_code}")
-        client.subscribe(target_topic)
-
-    # Create an MQTT client instance
-    client = mqtt.Client()
-    client.on_message = on_message
-    client.on_connect = on_connect
-
-    # Connect to the broker
-    try:
-        client.connect("mqtt-server", 1883, 60)
-        logging.info("MQTT client connected to broker")
-    except Exception as e:
-        logging.exception(f"Failed to connect to MQTT broker: {e}")
-        return jsonify({"error": "Failed to connect to MQTT broker"}), 500
-    
-    client.loop_start()
 
-    # Wait for the result event to be set by the on_message callback
-    if not result_event.wait(timeout=20):  # Wait up to 20 seconds for a message.
-        logging.warning("Timeout waiting for MQTT message")
-    
-    client.loop_stop()
+    target_key = result_key(target_agent, target_check, arg_list)
+
+    logging.debug("Information contained within the request:\n"
+                  "\tAgent looking for: %s\n"
+                  "\tCheck supposed to run: %s\n"
+                  "\tTopic supposed to read from: %s",
+                  target_agent, target_check, result_topic(target_key))
+
+    # The shared subscriber fills the cache, we never talk to the broker here.
+    # If this round's result has not landed yet wait for it a little.
+    started = time.monotonic()
+    result = results.wait(target_key, timeout=READ_RESULT_WAIT)
+    metrics.READ_RESULT_WAIT.observe(time.monotonic() - started)
 
-    if mqtt_message['description'] is not None:
-        logging.info(f"Returning response with message: {mqtt_message}")
-        return Response(response=mqtt_message['description'], status=mqtt_message['status'])
-    else:
+    if result is None:
         logging.warning("No relevant message received or timed out")
+        metrics.READ_RESULTS.labels(408).inc()
         return jsonify({"error": "No relevant message received or timed out"}), 408
 
+    logging.debug("Returning response with message: %s", result)
+    status = result_status(result)
+    metrics.READ_RESULTS.labels(status).inc()
+    return Response(response=result['description'], status=status)
+
+
+@app.route('/read-results', methods=['POST'])
+def read_results():
+    """
+    Read the results of many checks (e.g. all of a team's) in one request.
+
+    Args:
+        - checks: list of {reporting-agent, check-ran, arg-list}, as for /read-result.
+
+    Returns a JSON list 'results' with, for every check in order, its
+    reporting-agent, check-ran, arg-list, the status /read-result would
+    have answered (200, 406 or 408) and the description. The HTTP status
+    is 200 only if every check passed, see bulk_status.
+    """
+    try:
+        checks = parse_bulk_request(request.get_json())
+    except ValueError as e:
+        logging.error("Bad /read-results request: %s", e)
+        metrics.READ_RESULTS.labels(400).inc()
+        return jsonify({"error": str(e)}), 400
+
+    # One wait for all of them, the results come in while we wait on the first.
+    started = time.monotonic()
+    found = results.wait_all([key for check, key in checks], timeout=READ_RESULT_WAIT)
+    metrics.READ_RESULT_WAIT.observe(time.monotonic() - started)
+
+    answers = [bulk_answer(check, result) for (check, key), result in zip(checks, found)]
+    for answer in answers:
+        metrics.READ_RESULTS.labels(answer['status']).inc()
+
+    return jsonify({"results": answers}), bulk_status(answers)
+
+
+def history_endpoint(query, trend=False):
+    if history is None:
+        return jsonify({"error": "Result history is disabled"}), 404
+
+    try:
+        kwargs = history_query(request.args, trend)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"results": query(**kwargs)}), 200
+
+
+@app.route('/history/latest', methods=['GET'])
+def history_latest():
+    """
+    Latest stored result of an agent's checks.
+
+    Query string:
+        - reporting-agent
+        - check-ran, args: narrow it down to a check (optional)
+        - since-ms, until-ms: epoch milliseconds the result arrived between (optional)
+    """
+    return history_endpoint(history.latest if history else None)
+
+
+@app.route('/history/trend', methods=['GET'])
+def history_trend():
+    """
+    Passed and failed results of a check per time bucket.
+
+    Query string: as /history/latest, check-ran is required,
+    bucket-seconds sets the bucket size (default 300).
+    """
+    return history_endpoint(history.trend if history else None, trend=True)
+
+
+@app.route('/history/flaps', methods=['GET'])
+def history_flaps():
+    """
+    How often an agent's checks flipped between passing and failing.
+
+    Query string: as /history/latest.
+    """
+    return history_endpoint(history.flaps if history else None)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+        Prometheus metrics of this API agent.
+    """
+    body, content_type = metrics.render()
+    return Response(body, status=200, content_type=content_type)
+
+def main():
+    global result_subscriber, check_publisher
+
+    if API_SERVER_MODE == 'async':
+        import async_app
+        async_app.main()
+        return
+
+    # The result subscriber keeps the cache up to date, checks go out over
+    # one long-lived connection instead of one per request.
+    result_subscriber = ResultSubscriber(results, host=MQTT_HOST, port=MQTT_PORT, history=history)
+    check_publisher = CheckPublisher(host=MQTT_HOST, port=MQTT_PORT, max_inflight=MQTT_MAX_INFLIGHT)
+
+    result_subscriber.start()
+    check_publisher.start()
+    app.run('0.0.0.0', port=API_PORT)
+
+
 if __name__ == '__main__':
-    app.run('0.0.0.0')
+    main()
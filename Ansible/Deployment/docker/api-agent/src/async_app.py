@@ -0,0 +1,225 @@
+"""
+    asyncio flavour of the API agent (API_SERVER_MODE=async).
+
+    Serves the same /publish-checks and /read-result endpoints as app.py but
+    every request is a coroutine, and all of them share one aiomqtt
+    connection for both publishing checks and receiving results. A
+    /read-result waiting on an agent costs a pending future, not a thread,
+    and every reader of the same result shares that future.
+"""
+import asyncio
+import logging
+import time
+
+import aiomqtt
+from quart import Quart, request, Response, jsonify
+
+from broker import RESULT_SUBSCRIPTIONS, handle_message
+from history import history_query
+import metrics
+from result_cache import bulk_answer, bulk_status, parse_bulk_request, result_key, result_status, result_topic
+from shared import (API_PORT, CHECK_ROUTING, MQTT_HOST, MQTT_MAX_INFLIGHT, MQTT_PORT, PUBLISH_CHECKS_TIMEOUT,
+                    READ_RESULT_WAIT, check_message_cache, history, results)
+
+# Seconds between reconnect attempts when the broker goes away.
+MQTT_RECONNECT_DELAY = 2
+
+app = Quart(__name__)
+
+
+class MQTTLink:
+    """
+        The single shared MQTT connection of the async API.
+    """
+    def __init__(self):
+        self.client = None
+        self.connected = asyncio.Event()
+        self.connected_before = False
+
+    async def run(self):
+        """
+            Keep a connection to the broker up, feeding every result to the cache.
+        """
+        while True:
+            try:
+                async with aiomqtt.Client(MQTT_HOST, MQTT_PORT, max_inflight_messages=MQTT_MAX_INFLIGHT) as client:
+                    await client.subscribe(RESULT_SUBSCRIPTIONS)
+                    self.client = client
+                    self.connected.set()
+                    logging.info("Connected to MQTT broker")
+
+                    if self.connected_before:
+                        metrics.MQTT_RECONNECTS.labels('async').inc()
+                    self.connected_before = True
+
+                    async for message in client.messages:
+                        handle_message(results, message.topic.value, message.payload, message.retain, history)
+            except aiomqtt.MqttError as e:
+                logging.error("MQTT connection lost: %s, reconnecting in %s seconds", e, MQTT_RECONNECT_DELAY)
+            finally:
+                self.client = None
+                self.connected.clear()
+
+            await asyncio.sleep(MQTT_RECONNECT_DELAY)
+
+    async def publish_all(self, messages, timeout):
+        """
+            Publish the messages (QoS 1) and return once the broker acked all of them.
+
+            Raises asyncio.TimeoutError if that takes longer than `timeout`
+            seconds, aiomqtt.MqttError if the connection is lost.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        await asyncio.wait_for(self.connected.wait(), timeout)
+
+        # The connection can drop between being signalled and us getting here.
+        client = self.client
+        if client is None:
+            raise aiomqtt.MqttError("Not connected to the MQTT broker")
+
+        publishes = asyncio.gather(*(client.publish(message['topic'], message['payload'], qos=1) for message in messages))
+        await asyncio.wait_for(publishes, max(deadline - loop.time(), 0))
+
+
+mqtt_link = None
+
+
+@app.before_serving
+async def start_mqtt():
+    global mqtt_link
+    mqtt_link = MQTTLink()
+    app.add_background_task(mqtt_link.run)
+
+
+@app.route('/publish-checks', methods=['POST'])
+async def publish_checks():
+    """
+        Publish a given check from main scoring engine.
+
+        Same body as app.py's /publish-checks.
+    """
+    try:
+        messages = check_message_cache.messages_for(await request.get_data(), CHECK_ROUTING)
+    except ValueError as e:
+        logging.error("Bad /publish-checks request: %s", e)
+        return jsonify({"error": str(e)}), 400
+
+    metrics.publish_tracker.published(message['key'] for message in messages)
+    try:
+        with metrics.PUBLISH_CHECKS.time():
+            await mqtt_link.publish_all(messages, timeout=PUBLISH_CHECKS_TIMEOUT)
+    except (asyncio.TimeoutError, aiomqtt.MqttError) as e:
+        logging.error("Failed to publish checks: %s", e)
+        return jsonify({"error": "Failed to publish checks"}), 500
+
+    return Response("Checks have been published.", status=200)
+
+
+@app.route('/read-result', methods=['POST'])
+async def read_result():
+    """
+        Read a result for the agent, check and arguments in the body.
+
+        Same body and answers as app.py's /read-result.
+    """
+    req = await request.get_json()
+    target_agent = req.get('reporting-agent')
+    target_check = req.get('check-ran')
+    arg_list = req.get('arg-list')
+
+    if not target_agent or not target_check or arg_list is None:
+        logging.error("Missing required parameters in the request")
+        metrics.READ_RESULTS.labels(400).inc()
+        return jsonify({"error": "Missing required parameters"}), 400
+
+    target_key = result_key(target_agent, target_check, arg_list)
+    logging.debug("Waiting for %s", result_topic(target_key))
+
+    started = time.monotonic()
+    result = await results.wait_async(target_key, READ_RESULT_WAIT)
+    metrics.READ_RESULT_WAIT.observe(time.monotonic() - started)
+
+    if result is None:
+        logging.warning("No relevant message received or timed out")
+        metrics.READ_RESULTS.labels(408).inc()
+        return jsonify({"error": "No relevant message received or timed out"}), 408
+
+    status = result_status(result)
+    metrics.READ_RESULTS.labels(status).inc()
+    return Response(response=result['description'], status=status)
+
+
+@app.route('/read-results', methods=['POST'])
+async def read_results():
+    """
+        Read the results of many checks in one request.
+
+        Same body and answers as app.py's /read-results.
+    """
+    try:
+        checks = parse_bulk_request(await request.get_json())
+    except ValueError as e:
+        logging.error("Bad /read-results request: %s", e)
+        metrics.READ_RESULTS.labels(400).inc()
+        return jsonify({"error": str(e)}), 400
+
+    started = time.monotonic()
+    found = await results.wait_all_async([key for check, key in checks], READ_RESULT_WAIT)
+    metrics.READ_RESULT_WAIT.observe(time.monotonic() - started)
+
+    answers = [bulk_answer(check, result) for (check, key), result in zip(checks, found)]
+    for answer in answers:
+        metrics.READ_RESULTS.labels(answer['status']).inc()
+
+    return jsonify({"results": answers}), bulk_status(answers)
+
+
+async def history_endpoint(query, trend=False):
+    if history is None:
+        return jsonify({"error": "Result history is disabled"}), 404
+
+    try:
+        kwargs = history_query(request.args, trend)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # SQLite is blocking, keep it off the event loop.
+    return jsonify({"results": await asyncio.to_thread(query, **kwargs)}), 200
+
+
+@app.route('/history/latest', methods=['GET'])
+async def history_latest():
+    """
+        Same query and answer as app.py's /history/latest.
+    """
+    return await history_endpoint(history.latest if history else None)
+
+
+@app.route('/history/trend', methods=['GET'])
+async def history_trend():
+    """
+        Same query and answer as app.py's /history/trend.
+    """
+    return await history_endpoint(history.trend if history else None, trend=True)
+
+
+@app.route('/history/flaps', methods=['GET'])
+async def history_flaps():
+    """
+        Same query and answer as app.py's /history/flaps.
+    """
+    return await history_endpoint(history.flaps if history else None)
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """
+        Prometheus metrics of this API agent.
+    """
+    body, content_type = metrics.render()
+    return Response(body, status=200, content_type=content_type)
+
+
+def main():
+    app.run(host='0.0.0.0', port=API_PORT, use_reloader=False)
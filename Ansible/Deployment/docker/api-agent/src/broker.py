@@ -0,0 +1,209 @@
+import json
+import logging
+import threading
+import time
+import zlib
+
+# Paho MQTT python library.
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import MQTTProtocolVersion
+
+from metrics import MQTT_RECONNECTS, publish_tracker
+from payloads import decode_payload, is_msgpack
+from result_cache import RESULT_TOPIC_PREFIX, key_from_topic
+
+# Agents with result batching on publish all their results of a round
+# to "<BATCH_TOPIC_PREFIX><hostname>" as one compressed message.
+BATCH_TOPIC_PREFIX = "batch-results/"
+
+# (topic filter, QoS) pairs of everything that carries results.
+RESULT_SUBSCRIPTIONS = [(f"{RESULT_TOPIC_PREFIX}/#", 1), (f"{BATCH_TOPIC_PREFIX}#", 1)]
+
+
+class ResultSubscriber:
+    """
+        One long-lived MQTT connection that listens to every result topic
+        and keeps the ResultCache up to date.
+
+        The agents publish their results retained under RESULT_TOPIC_PREFIX
+        (see result_cache.result_topic), that subtree and the batches are
+        all we subscribe to.
+
+        Batches (see BATCH_TOPIC_PREFIX) are unpacked into the same
+        results the individual topics would have carried.
+    """
+    def __init__(self, cache, host="mqtt-server", port=1883, history=None):
+        self.cache = cache
+        self.history = history
+        self.host = host
+        self.port = port
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+        # Do not hammer the broker if it goes away, paho handles the reconnect.
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        self.connected_before = False
+
+    def start(self):
+        """
+            Connect in the background. paho's network thread will keep
+            reconnecting on its own if the broker is not up yet.
+        """
+        self.client.connect_async(self.host, self.port, 60)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logging.error("Result subscriber failed to connect: %s", reason_code)
+            return
+
+        # Subscribe from on_connect so the subscription survives reconnects.
+        # The retained results are delivered right after, which warms the cache.
+        logging.info("Result subscriber connected to MQTT broker")
+        client.subscribe(RESULT_SUBSCRIPTIONS)
+
+        if self.connected_before:
+            MQTT_RECONNECTS.labels('subscriber').inc()
+        self.connected_before = True
+
+    def on_message(self, client, userdata, message):
+        handle_message(self.cache, message.topic, message.payload, message.retain, self.history)
+
+
+class CheckPublisher:
+    """
+        Long-lived MQTT connection /publish-checks sends the checks over.
+
+        Instead of a CONNECT/DISCONNECT per request, the connection stays up
+        and paho reconnects it on its own. All checks of a request are handed
+        to paho at once, up to `max_inflight` QoS 1 publishes are on the wire
+        unacknowledged at a time, the rest are queued and follow as the
+        PUBACKs come back.
+
+        paho's publish is thread-safe, concurrent requests publish side by
+        side and each only waits for the acks of its own checks.
+    """
+    def __init__(self, host="mqtt-server", port=1883, max_inflight=100):
+        self.host = host
+        self.port = port
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=MQTTProtocolVersion.MQTTv5)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        self.connected = threading.Event()
+        self.connected_before = False
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, 60)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logging.error("Check publisher failed to connect: %s", reason_code)
+            return
+        logging.info("Check publisher connected to MQTT broker")
+        self.connected.set()
+
+        if self.connected_before:
+            MQTT_RECONNECTS.labels('publisher').inc()
+        self.connected_before = True
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        logging.warning("Check publisher disconnected: %s", reason_code)
+        self.connected.clear()
+
+    def publish_all(self, messages, timeout):
+        """
+            Publish every {'topic', 'payload'} in `messages` with QoS 1 and
+            return once the broker acked all of them.
+
+            Raises TimeoutError if that doesn't happen within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+
+        if not self.connected.wait(timeout):
+            raise TimeoutError("Not connected to the MQTT broker")
+
+        infos = [self.client.publish(message['topic'], message['payload'], qos=1) for message in messages]
+
+        for info in infos:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0))
+            except (RuntimeError, ValueError) as e:
+                raise TimeoutError(f"Publish failed: {e}")
+
+            if not info.is_published():
+                raise TimeoutError("Timed out waiting for the broker to ack the checks")
+
+
+def handle_message(cache, topic, payload, retained=False, history=None):
+    """
+        Store whatever results a message from the broker carries in `cache`,
+        and in `history` (a ResultHistory) if there is one.
+        Messages that are not results are ignored.
+
+        `retained` is the message's retain flag, see ResultCache.put.
+    """
+    if topic.startswith(BATCH_TOPIC_PREFIX):
+        handle_batch(cache, topic, payload, retained, history)
+        return
+
+    if not topic.startswith(RESULT_TOPIC_PREFIX + "/"):
+        return
+
+    try:
+        result = decode_payload(payload)
+    except Exception as e:
+        logging.warning("Dropping undecodable result on %s: %s", topic, e)
+        return
+
+    store_result(cache, topic, result, retained, history)
+
+
+def handle_batch(cache, topic, payload, retained, history):
+    try:
+        # Batches are zlib compressed JSON unless the agent sends msgpack.
+        if is_msgpack(payload):
+            batch = decode_payload(payload)
+        else:
+            batch = json.loads(zlib.decompress(payload).decode('utf8'))
+    except Exception as e:
+        logging.warning("Dropping undecodable batch on %s: %s", topic, e)
+        return
+
+    if batch.get('version') != 1:
+        logging.warning("Dropping batch on %s with unknown version %s", topic, batch.get('version'))
+        return
+
+    for entry in batch.get('results', []):
+        store_result(cache, entry['topic'], entry['result'], retained, history)
+
+
+def store_result(cache, topic, result, retained, history):
+    key = key_from_topic(topic, result)
+    if key is None:
+        logging.warning("Result on %s does not match its payload, dropping it", topic)
+        return
+
+    cache.put(key, result, retained)
+
+    if history is not None:
+        history.record(key, result)
+
+    # A retained replay is not the answer to anything we just published.
+    if not retained:
+        publish_tracker.landed(key)
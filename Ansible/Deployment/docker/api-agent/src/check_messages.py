@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+from payloads import encode_payload
+from result_cache import result_key
+
+# orjson is optional, it serializes the check messages several times faster.
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj)
+
+    loads = json.loads
+
+# Topic the checks are broadcast on, routed checks go to "<CHECK_TOPIC>/<target-agent>".
+CHECK_TOPIC = "checks"
+
+# broadcast: every check goes to CHECK_TOPIC and every agent filters them.
+# routed:    every check goes to "<CHECK_TOPIC>/<target-agent>" and only that agent gets it.
+ROUTING_MODES = ("broadcast", "routed")
+
+
+def build_check_messages(req, routing, payload_format="json"):
+    """
+        Turn a /publish-checks body into the MQTT messages for the agents.
+
+        Args:
+            - req: the decoded /publish-checks body.
+            - routing: one of ROUTING_MODES.
+            - payload_format: one of payloads.PAYLOAD_FORMATS.
+
+        Returns:
+            list of {'topic': ..., 'payload': ..., 'key': ...} dictionaries,
+            'key' being the result key the check will report under.
+    """
+    # Parse out the important information
+    list_of_checks = req.get('checks', [])
+    repo_ip = req.get('repo-ip', "")
+
+    # Create an array to publish multiple messages at once.
+    # Multiple small json dictionaries that is.
+    messages = []
+
+    for check in list_of_checks:
+
+        # Convert the random bytes in here to a dictionary that can be parsed.
+        mqtt_data = {
+            "agent": check["target-agent"],
+            "downloadURL": f"http://{repo_ip}:8080/checks/{check['target-script']}",
+            "msgtype": "check", # TODO: If it needs to be refreshed, then let everyone know.
+            "run-method": check['run-method'],
+            "arg-list": check['arg-list']
+        }
+
+        # Only send a timeout if there is one, the agents fall back to their own default.
+        if check.get('timeout') is not None:
+            mqtt_data['timeout'] = check['timeout']
+
+        if payload_format == "json":
+            mqtt_data = dumps(mqtt_data)
+        else:
+            mqtt_data = encode_payload(mqtt_data, payload_format)
+
+        # Routed checks only reach the agent they are for.
+        if routing == "routed":
+            topic = f"{CHECK_TOPIC}/{check['target-agent']}"
+        else:
+            topic = CHECK_TOPIC
+
+        messages.append({'topic': topic,
+                         'payload': mqtt_data,
+                         'key': result_key(check['target-agent'], check['target-script'], check['arg-list'])})
+
+    return messages
+
+
+class CheckMessageCache:
+    """
+        Remembers the MQTT messages built for recent /publish-checks bodies.
+
+        The scoring engine sends every team the same body every round, so
+        the messages are looked up by a hash of the raw body and a repeated
+        round skips parsing and serializing entirely. A body whose checks
+        changed hashes differently and is built fresh; the `size` most
+        recently used bodies are kept (one per team in steady state, so it
+        must be at least the number of teams or every round misses).
+
+        The messages are encoded in `payload_format`.
+    """
+    def __init__(self, size=1024, payload_format="json"):
+        self.size = size
+        self.payload_format = payload_format
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def messages_for(self, body, default_routing):
+        """
+            The messages for a raw /publish-checks body.
+
+            Raises ValueError if the body is not valid JSON or asks for an
+            unknown routing mode.
+        """
+        key = hashlib.sha256(default_routing.encode("utf-8") + b"\0" + body).digest()
+
+        with self.lock:
+            messages = self.entries.get(key)
+            if messages is not None:
+                self.entries.move_to_end(key)
+                return messages
+
+        req = loads(body)
+        routing = req.get('routing', default_routing)
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode {routing}")
+
+        messages = build_check_messages(req, routing, self.payload_format)
+
+        with self.lock:
+            self.entries[key] = messages
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return messages
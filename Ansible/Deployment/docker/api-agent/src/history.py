@@ -0,0 +1,223 @@
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+
+from result_cache import result_status
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id          INTEGER PRIMARY KEY,
+    agent       TEXT NOT NULL,
+    check_name  TEXT NOT NULL,
+    args        TEXT NOT NULL,
+    received_ms INTEGER NOT NULL,
+    produced_ms INTEGER,
+    agent_run   TEXT,
+    seq         INTEGER,
+    status      INTEGER NOT NULL,
+    result      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_check ON results (agent, check_name, args, received_ms);
+CREATE INDEX IF NOT EXISTS results_by_time ON results (received_ms);
+CREATE UNIQUE INDEX IF NOT EXISTS results_once ON results (agent, check_name, args, agent_run, seq);
+"""
+
+INSERT = """
+INSERT OR IGNORE INTO results (agent, check_name, args, received_ms, produced_ms, agent_run, seq, status, result)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+class ResultHistory:
+    """
+        Append-only log of every result the API has seen, in SQLite (WAL mode)
+        at `path`, indexed by (agent, check, args, time) and by time.
+
+        Results are handed to a writer thread and inserted in batches so the
+        MQTT thread never waits on the disk. A result delivered twice (QoS 1
+        redelivery, retained replay after a restart) is stored once, going by
+        the agent's run id and sequence number.
+
+        Readers get a connection per thread; with WAL they don't block the
+        writer or each other.
+    """
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+
+        connection = self.connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.close()
+
+        self.pending = queue.SimpleQueue()
+        self.local = threading.local()
+
+        threading.Thread(target=self.writer, name="result-history", daemon=True).start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def reader(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def record(self, key, result):
+        """
+            Queue `result` (stored in the cache under `key`) to be written.
+        """
+        self.pending.put((key, result, now_ms()))
+
+    def writer(self):
+        connection = self.connect()
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = []
+            for (agent, check, args), result, received_ms in batch:
+                try:
+                    rows.append((agent, check, args, received_ms,
+                                 result.get('timestamp-ms'), result.get('agent-run'), result.get('seq'),
+                                 result_status(result), json.dumps(result)))
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.warning("Not storing malformed result of %s-%s-%s: %s", agent, check, args, e)
+
+            try:
+                with connection:
+                    connection.executemany(INSERT, rows)
+            except sqlite3.Error as e:
+                logging.error("Failed to store %s results: %s", len(rows), e)
+
+    def warm(self, cache, max_age):
+        """
+            Put the results of the last `max_age` seconds back in `cache`, e.g.
+            after a restart. They go in as retained results, so the cache ages
+            them by the agent's timestamp.
+        """
+        since = now_ms() - int(max_age * 1000)
+        rows = self.reader().execute(
+            "SELECT agent, check_name, args, result FROM results WHERE received_ms >= ? ORDER BY id", (since,))
+
+        count = 0
+        for agent, check, args, result in rows:
+            cache.put((agent, check, args), json.loads(result), True)
+            count += 1
+        return count
+
+    def latest(self, agent, check=None, args=None, since_ms=None, until_ms=None):
+        """
+            The latest result of every (agent, check, args) matching the filters.
+        """
+        where, params = self.filters(agent, check, args, since_ms, until_ms)
+        # SQLite fills the bare columns from the row MAX() picked, the highest
+        # id is the last one stored (received_ms can tie).
+        rows = self.reader().execute(
+            f"SELECT agent, check_name, args, MAX(id), received_ms, status, result FROM results WHERE {where} "
+            "GROUP BY agent, check_name, args ORDER BY agent, check_name, args", params)
+
+        return [{'reporting-agent': agent,
+                 'check-ran': check,
+                 'args': args,
+                 'received-ms': received_ms,
+                 'status': status,
+                 'result': json.loads(result)}
+                for agent, check, args, row_id, received_ms, status, result in rows]
+
+    def trend(self, agent, check, args=None, since_ms=None, until_ms=None, bucket_seconds=300):
+        """
+            Passed and failed results per `bucket_seconds` for one check.
+        """
+        where, params = self.filters(agent, check, args, since_ms, until_ms)
+        bucket_ms = int(bucket_seconds * 1000)
+        rows = self.reader().execute(
+            f"SELECT received_ms / ? * ? AS bucket, SUM(status = 200), SUM(status != 200) FROM results WHERE {where} "
+            "GROUP BY bucket ORDER BY bucket", [bucket_ms, bucket_ms] + params)
+
+        return [{'start-ms': bucket, 'passed': passed, 'failed': failed} for bucket, passed, failed in rows]
+
+    def flaps(self, agent, check=None, args=None, since_ms=None, until_ms=None):
+        """
+            How often each matching check flipped between passing and failing.
+            The flap rate is flips per consecutive pair of results.
+        """
+        where, params = self.filters(agent, check, args, since_ms, until_ms)
+        rows = self.reader().execute(
+            "SELECT agent, check_name, args, COUNT(*), SUM(previous IS NOT NULL AND (previous = 200) != (status = 200)) "
+            "FROM (SELECT agent, check_name, args, status, "
+            "      LAG(status) OVER (PARTITION BY agent, check_name, args ORDER BY received_ms, id) AS previous "
+            f"      FROM results WHERE {where}) "
+            "GROUP BY agent, check_name, args ORDER BY agent, check_name, args", params)
+
+        return [{'reporting-agent': agent,
+                 'check-ran': check,
+                 'args': args,
+                 'samples': samples,
+                 'flaps': flaps,
+                 'flap-rate': flaps / (samples - 1) if samples > 1 else 0.0}
+                for agent, check, args, samples, flaps in rows]
+
+    @staticmethod
+    def filters(agent, check=None, args=None, since_ms=None, until_ms=None):
+        clauses, params = ["agent = ?"], [agent]
+        for clause, value in (("check_name = ?", check),
+                              ("args = ?", args),
+                              ("received_ms >= ?", since_ms),
+                              ("received_ms <= ?", until_ms)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return " AND ".join(clauses), params
+
+
+def history_query(params, trend=False):
+    """
+        Keyword arguments for a ResultHistory query from the query string
+        of a /history/* request (reporting-agent, check-ran, args, since-ms,
+        until-ms, and for a `trend` check-ran is required and bucket-seconds
+        allowed). `args` is the arguments the check ran with, separated by
+        single spaces (e.g. "10.0.0.1 22").
+
+        Raises ValueError if a required parameter is missing, a number isn't
+        one or bucket-seconds is shorter than a millisecond.
+    """
+    query = {'agent': params.get('reporting-agent'),
+             'check': params.get('check-ran'),
+             'args': params.get('args')}
+
+    if not query['agent'] or (trend and not query['check']):
+        raise ValueError("Missing reporting-agent" + (" or check-ran" if trend else ""))
+
+    numbers = [('since-ms', 'since_ms', int), ('until-ms', 'until_ms', int)]
+    if trend:
+        numbers.append(('bucket-seconds', 'bucket_seconds', float))
+
+    for name, key, kind in numbers:
+        if params.get(name) is not None:
+            try:
+                query[key] = kind(params[name])
+            except ValueError:
+                raise ValueError(f"{name} must be a number")
+
+    # Buckets are whole milliseconds, anything shorter would divide by zero.
+    bucket_seconds = query.get('bucket_seconds')
+    if bucket_seconds is not None and not (math.isfinite(bucket_seconds) and bucket_seconds >= 0.001):
+        raise ValueError("bucket-seconds must be at least 0.001")
+
+    return query
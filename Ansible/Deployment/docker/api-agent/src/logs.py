@@ -0,0 +1,33 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+        QueueHandler that leaves formatting the record to the listener
+        thread, a request thread that logs only pays for the queue put.
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level):
+    """
+        Route the root logger through a queue to stderr.
+
+        The records are formatted and written by a background thread, the
+        QueueListener that is returned.
+    """
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
@@ -0,0 +1,82 @@
+"""
+    Prometheus metrics of the API agent, served on /metrics by both
+    app.py and async_app.py.
+"""
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Latencies of a scoring round, from a few hundred ms (a fast check on a
+# routed topic) to the PUBLISH_REPORT_TIMEOUT.
+ROUND_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60)
+
+READ_RESULTS = Counter('api_read_result_total',
+                       '/read-result answers (and /read-results entries) by status (200 passed, 406 failed, 408 no result)',
+                       ['status'])
+
+READ_RESULT_WAIT = Histogram('api_read_result_wait_seconds',
+                             'Time a /read-result spent waiting for its result',
+                             buckets=ROUND_BUCKETS)
+
+PUBLISH_TO_RESULT = Histogram('api_publish_to_result_seconds',
+                              'Time from publishing a check to its result landing in the cache',
+                              buckets=ROUND_BUCKETS)
+
+PUBLISH_CHECKS = Histogram('api_publish_checks_seconds',
+                           'Time /publish-checks took to get every check acked by the broker',
+                           buckets=ROUND_BUCKETS)
+
+MQTT_RECONNECTS = Counter('api_mqtt_reconnects_total',
+                          'Times a connection to the MQTT broker came back after being lost',
+                          ['connection'])
+
+CACHED_RESULTS = Gauge('api_cached_results', 'Results currently held in the result cache')
+
+WAITING_KEYS = Gauge('api_waiting_results', 'Results at least one /read-result is waiting on')
+
+
+def watch_cache(cache):
+    """
+        Report the size of `cache` and its waiter registry at scrape time.
+    """
+    CACHED_RESULTS.set_function(lambda: len(cache))
+    WAITING_KEYS.set_function(cache.waiting)
+
+
+def render():
+    """
+        (body, content type) of a /metrics answer.
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class PublishTracker:
+    """
+        Remembers when the check for each result key was last published so
+        the time until its result lands can be observed.
+
+        Only the latest publish of a key counts, one entry per check in
+        the game so this does not grow round over round.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # result key -> monotonic time the check was published
+        self.published_at = {}
+
+    def published(self, keys):
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                self.published_at[key] = now
+
+    def landed(self, key):
+        with self.lock:
+            published_at = self.published_at.pop(key, None)
+
+        if published_at is not None:
+            PUBLISH_TO_RESULT.observe(time.monotonic() - published_at)
+
+
+publish_tracker = PublishTracker()
@@ -0,0 +1,71 @@
+"""
+    Encoding of the check and result payloads.
+
+    json:    the payload is the UTF-8 JSON document, like it always was.
+    msgpack: a marker byte followed by the msgpack document (MSGPACK),
+             zlib compressed when it is large (MSGPACK_ZLIB).
+
+    A JSON document never starts with a marker byte, so whoever receives a
+    payload can decode it whatever the sender picked, the format only has
+    to be chosen on the sending side (PAYLOAD_FORMAT for the checks the API
+    sends, payload_format for the results of an agent).
+
+    Keep in sync with encode_payload/decode_payload in the agent's agent.py.
+"""
+import json
+import zlib
+
+# msgpack is optional, without it everything goes out as JSON.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PAYLOAD_FORMATS = ("json", "msgpack")
+
+MSGPACK = b"\x01"
+MSGPACK_ZLIB = b"\x02"
+
+# msgpack documents longer than this (bytes) are compressed, in practice
+# results with a lot of check output and batches.
+COMPRESS_THRESHOLD = 1024
+
+
+def encode_payload(obj, payload_format="json"):
+    """
+        `obj` as a payload in `payload_format`, JSON if msgpack is not installed.
+    """
+    if payload_format == "msgpack" and msgpack is not None:
+        packed = msgpack.packb(obj)
+        if len(packed) > COMPRESS_THRESHOLD:
+            compressed = zlib.compress(packed)
+            if len(compressed) < len(packed):
+                return MSGPACK_ZLIB + compressed
+        return MSGPACK + packed
+
+    return json.dumps(obj).encode('utf-8')
+
+
+def is_msgpack(payload):
+    return payload[:1] in (MSGPACK, MSGPACK_ZLIB)
+
+
+def decode_payload(payload):
+    """
+        The document in a payload of any of the PAYLOAD_FORMATS.
+
+        Raises ValueError (or a subclass) if it can't be decoded.
+    """
+    if not is_msgpack(payload):
+        return json.loads(payload)
+
+    if msgpack is None:
+        raise ValueError("msgpack payload received but msgpack is not installed")
+
+    packed = payload[1:]
+    if payload[:1] == MSGPACK_ZLIB:
+        try:
+            packed = zlib.decompress(packed)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed payload: {e}")
+    return msgpack.unpackb(packed)
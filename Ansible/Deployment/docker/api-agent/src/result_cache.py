@@ -0,0 +1,333 @@
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+# Every result topic is RESULT_TOPIC_PREFIX/<2 hex>/<32 hex>, see result_topic.
+RESULT_TOPIC_PREFIX = "result"
+
+
+def result_key(agent, check, arg_list):
+    """
+        Build the key a result is stored under in the ResultCache.
+
+        The key is the (reporting-agent, check-ran, args) tuple, args being
+        the arguments the agent runs the check with (every arg-list entry
+        split on whitespace) joined by single spaces, e.g. "10.0.0.1 22".
+    """
+    args = ' '.join(token for arg in arg_list for token in arg.split())
+    return (agent, check, args)
+
+
+def result_topic(key):
+    """
+        The MQTT topic the agent publishes the result for `key` to.
+
+        The key is encoded as a JSON array and hashed, so any agent, check
+        or argument (dashes, '#', '+', '/' and all) gets a topic of the same
+        length and two results never share one.
+
+        Keep in sync with result_topic in the agent's agent.py.
+    """
+    canonical = json.dumps(list(key), separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+    return f"{RESULT_TOPIC_PREFIX}/{digest[:2]}/{digest}"
+
+
+def key_from_topic(topic, result):
+    """
+        Recover the result key of a result received on `topic` from its
+        decoded payload, which names the agent, check and args.
+
+        Returns None if the topic does not belong to the payload.
+    """
+    key = (result.get('reporting-agent'), result.get('check-ran'), result.get('args'))
+    if not all(isinstance(part, str) for part in key) or result_topic(key) != topic:
+        return None
+    return key
+
+
+def result_status(result):
+    """
+        HTTP status /read-result answers with for a result, 200 if the check passed.
+    """
+    return 200 if result['exit-code'] == 0 else 406
+
+
+def parse_bulk_request(req):
+    """
+        The checks of a /read-results body, {"checks": [{reporting-agent, check-ran, arg-list}, ...]},
+        as (check, result key) pairs.
+
+        Raises ValueError if the body is malformed.
+    """
+    checks = req.get('checks') if isinstance(req, dict) else None
+    if not isinstance(checks, list):
+        raise ValueError("Expected a 'checks' list")
+
+    parsed = []
+    for check in checks:
+        if not isinstance(check, dict) or not check.get('reporting-agent') or not check.get('check-ran') or check.get('arg-list') is None:
+            raise ValueError("Every check needs reporting-agent, check-ran and arg-list")
+        parsed.append((check, result_key(check['reporting-agent'], check['check-ran'], check['arg-list'])))
+
+    return parsed
+
+
+def bulk_answer(check, result):
+    """
+        The /read-results entry for one check, with the status /read-result
+        would have answered it with (408 if there is no result).
+    """
+    answer = {'reporting-agent': check['reporting-agent'],
+              'check-ran': check['check-ran'],
+              'arg-list': check['arg-list']}
+
+    if result is None:
+        answer['status'] = 408
+        answer['description'] = None
+    else:
+        answer['status'] = result_status(result)
+        answer['description'] = result['description']
+
+    return answer
+
+
+def bulk_status(answers):
+    """
+        HTTP status of a /read-results answer: 200 if every check passed,
+        otherwise 408 if any result is missing, else 406.
+    """
+    statuses = {answer['status'] for answer in answers}
+    if statuses <= {200}:
+        return 200
+    return 408 if 408 in statuses else 406
+
+
+def result_age_ns(result):
+    """
+        How many nanoseconds ago the agent produced this result, by the
+        agent's clock against ours.
+
+        Agents send 'timestamp-ms', milliseconds since the Unix epoch (UTC).
+        Older agents sent a local time string in 'timestamp', which is still
+        understood.
+    """
+    timestamp_ms = result.get('timestamp-ms')
+    if timestamp_ms is not None:
+        return time.time_ns() - int(timestamp_ms) * 1_000_000
+
+    last_timestamp = datetime.datetime.strptime(result['timestamp'], "%Y-%m-%d %H:%M:%S.%f").timestamp()
+    return time.time_ns() - int(last_timestamp * 1_000_000_000)
+
+
+def newer_than(result, other):
+    """
+        Whether `result` was produced after `other` according to the agent's
+        sequence numbers. Only results from the same agent run ('agent-run')
+        can be ordered, anything else counts as newer.
+    """
+    run = result.get('agent-run')
+    if run is None or run != other.get('agent-run'):
+        return True
+    return result.get('seq', 0) > other.get('seq', 0)
+
+
+class _Waiter:
+    """
+        Shared by every reader waiting on the same key. `future` is resolved
+        with the result once it lands, `count` is the number of readers still
+        waiting on it.
+    """
+    __slots__ = ('future', 'count')
+
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.count = 0
+
+
+class ResultCache:
+    """
+        In-memory view of the latest result for every (agent, check, args).
+
+        The cache is filled by the one long-lived MQTT subscriber and read by
+        /read-result. Entries older than `ttl` seconds are considered stale and
+        evicted, so a result from a previous round is never handed out.
+
+        Every entry gets its expiry (on our monotonic clock) when it is
+        stored, so checking freshness is an integer compare. A result that
+        was delivered live was just produced, it expires `ttl` after it
+        arrived no matter what the agent's clock says. Only a retained
+        result (delivered because we subscribed) is aged by its timestamp,
+        which is the one place clock skew between hosts matters.
+
+        Readers of a result that has not landed yet register in the waiter
+        registry. All readers of one key share a single future, which `put`
+        resolves when a fresh result for that key arrives. The same future
+        serves threads (`wait`) and coroutines (`wait_async`).
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._ttl_ns = int(ttl * 1_000_000_000)
+
+        # key -> (decoded result message, monotonic ns it expires at)
+        self._entries = {}
+
+        # key -> _Waiter, for keys somebody is waiting on.
+        self._waiters = {}
+
+        # Protects _entries and _waiters.
+        self._lock = threading.Lock()
+
+        # Last time (monotonic ns) we walked the whole cache looking for expired entries.
+        self._last_sweep = time.monotonic_ns()
+
+    def put(self, key, result, retained=False):
+        """
+            Store (or replace) the result for `key` and wake up the readers waiting on it.
+
+            `retained` is the MQTT retain flag of the message it came in, i.e.
+            whether the broker replayed it from its store instead of relaying it live.
+        """
+        now = time.monotonic_ns()
+        expires_at = self._expires_at(result, retained, now)
+
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and not newer_than(result, current[0]):
+                # Redelivered or out of order, we already have something newer.
+                return
+
+            self._entries[key] = (result, expires_at)
+            self._sweep(now)
+
+            # A stale (e.g. retained from last round) result doesn't end the wait.
+            if expires_at <= now:
+                return
+            waiter = self._waiters.pop(key, None)
+
+        if waiter is not None and not waiter.future.done():
+            waiter.future.set_result(result)
+
+    def get(self, key):
+        """
+            Return the fresh result stored for `key`, or None.
+        """
+        with self._lock:
+            return self._get_fresh(key)
+
+    def wait(self, key, timeout):
+        """
+            Return the fresh result stored for `key`, waiting up to `timeout`
+            seconds for one to arrive. Returns None on timeout.
+        """
+        result, waiter = self._register(key)
+        if waiter is None:
+            return result
+
+        try:
+            return waiter.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        finally:
+            self._release(key, waiter)
+
+    async def wait_async(self, key, timeout):
+        """
+            Coroutine version of `wait`.
+        """
+        result, waiter = self._register(key)
+        if waiter is None:
+            return result
+
+        try:
+            # shield so our timeout doesn't cancel the future the other readers share.
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter.future)), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._release(key, waiter)
+
+    def wait_all(self, keys, timeout):
+        """
+            `wait` for several keys at once, the results (None for the ones
+            that did not arrive) in the order of `keys`. All of them share
+            the same `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        return [self.wait(key, max(deadline - time.monotonic(), 0)) for key in keys]
+
+    async def wait_all_async(self, keys, timeout):
+        """
+            Coroutine version of `wait_all`.
+        """
+        return await asyncio.gather(*(self.wait_async(key, timeout) for key in keys))
+
+    def waiting(self):
+        """
+            Number of keys somebody is waiting on.
+        """
+        with self._lock:
+            return len(self._waiters)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _register(self, key):
+        # Returns (fresh result, None) or (None, waiter to wait on).
+        with self._lock:
+            result = self._get_fresh(key)
+            if result is not None:
+                return result, None
+
+            waiter = self._waiters.get(key)
+            if waiter is None:
+                waiter = self._waiters[key] = _Waiter()
+            waiter.count += 1
+            return None, waiter
+
+    def _release(self, key, waiter):
+        with self._lock:
+            waiter.count -= 1
+            # Last reader gave up, forget the key so the registry doesn't grow
+            # with results that never came.
+            if waiter.count == 0 and self._waiters.get(key) is waiter:
+                del self._waiters[key]
+
+    def _expires_at(self, result, retained, now):
+        if not retained:
+            return now + self._ttl_ns
+
+        try:
+            return now + self._ttl_ns - result_age_ns(result)
+        except (KeyError, ValueError, TypeError):
+            # No usable timestamp, we can't tell how old this is.
+            return now
+
+    def _get_fresh(self, key):
+        # Caller must hold self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry[1] <= time.monotonic_ns():
+            del self._entries[key]
+            return None
+
+        return entry[0]
+
+    def _sweep(self, now):
+        # Caller must hold self._lock.
+        # Walking the cache on every put would be wasteful, once per TTL is enough
+        # to keep it from growing with results nobody reads anymore.
+        if now - self._last_sweep < self._ttl_ns:
+            return
+        self._last_sweep = now
+
+        expired = [key for key, entry in self._entries.items() if entry[1] <= now]
+        for key in expired:
+            del self._entries[key]
@@ -0,0 +1,62 @@
+"""
+    Configuration of the API agent and the state both app.py and
+    async_app.py serve from, so the two modes can't drift apart.
+"""
+import logging
+import os
+
+from check_messages import CheckMessageCache
+from history import ResultHistory
+import metrics
+from result_cache import ResultCache
+
+# Timeout used to denote an old check.
+PUBLISH_REPORT_TIMEOUT = 45
+
+# How checks reach the agents, one of ROUTING_MODES (see check_messages.py).
+# A request can override this with its own "routing" field.
+CHECK_ROUTING = os.environ.get("CHECK_ROUTING", "broadcast")
+
+# Format of the check messages, one of PAYLOAD_FORMATS (see payloads.py).
+# The agents read either, results are decoded whatever format they come in.
+PAYLOAD_FORMAT = os.environ.get("PAYLOAD_FORMAT", "json")
+
+# flask: app.py's Flask app, a thread per request.
+# async: the same endpoints served from asyncio (see async_app.py).
+API_SERVER_MODE = os.environ.get("API_SERVER_MODE", "flask")
+
+# Port the API listens on, in either mode.
+API_PORT = int(os.environ.get("API_PORT", 5000))
+
+# How long /read-result waits for a result that has not been published yet.
+READ_RESULT_WAIT = 20
+
+# How long /publish-checks waits for the broker to ack the checks.
+PUBLISH_CHECKS_TIMEOUT = 20
+
+# The MQTT server is on the Docker Swarm, so we can use its Docker hostname.
+MQTT_HOST = os.environ.get("MQTT_HOST", "mqtt-server")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+
+# QoS 1 publishes allowed on the wire before waiting on PUBACKs.
+MQTT_MAX_INFLIGHT = int(os.environ.get("MQTT_MAX_INFLIGHT", 100))
+
+# SQLite file every result is also written to, "" to keep no history.
+RESULT_HISTORY = os.environ.get("RESULT_HISTORY", "results.sqlite3")
+
+# Latest result of every check, filled by one long-lived subscriber
+# instead of a new MQTT connection per /read-result.
+results = ResultCache(ttl=PUBLISH_REPORT_TIMEOUT)
+metrics.watch_cache(results)
+
+# A restarted API answers from its history until the agents report again.
+history = None
+if RESULT_HISTORY:
+    history = ResultHistory(RESULT_HISTORY)
+    logging.info("Loaded %s recent results from %s", history.warm(results, PUBLISH_REPORT_TIMEOUT), RESULT_HISTORY)
+
+# /publish-checks bodies whose check messages are kept, at least one per team.
+CHECK_MESSAGE_CACHE_SIZE = int(os.environ.get("CHECK_MESSAGE_CACHE_SIZE", 1024))
+
+# Serialized check messages of recent /publish-checks bodies.
+check_message_cache = CheckMessageCache(size=CHECK_MESSAGE_CACHE_SIZE, payload_format=PAYLOAD_FORMAT)
@@ -1,3 +1,5 @@
+import argparse
+import hashlib
 import json
 import csv
 import os
@@ -9,6 +11,8 @@ def read_checks_from_csv(file_path):
     """
     Reads check definitions from a CSV file and converts them into a list of dictionaries.
 
+    The file is read a row at a time, only the checks themselves are kept.
+
     Args:
         file_path (str): Path to the CSV file.
 
@@ -17,32 +21,36 @@ def read_checks_from_csv(file_path):
     """
     checks = []
     setup_params = {}
+    headers = None
     
-    with open(file_path, mode='r') as csvfile:
+    with open(file_path, mode='r', newline='') as csvfile:
         reader = csv.reader(csvfile)
-        rows = list(reader)
-        
-        # Extract setup parameters from rows 2-4
-        setup_params["api_ip"] = rows[1][1].strip() # This is the cell
-        setup_params["api_port"] = int(rows[2][1].strip())
-        setup_params["repo_ip"] = rows[3][1].strip()
-        
-        # Determine if we're using shorthand or long name
-        anonymize_checks = 1 if rows[5] == "Y" else 0
-
-        # Grab the headers of the rows that follow
-        headers = rows[8]
-
-        # Extract the checks from rows below.
-        for row in rows[9:]:
-            check = {headers[i]: value for i, value in enumerate(row)}
-            
-            print("Check")
-            print(check)
-            check['arg-list'] = check['arg-list'].split(",")  # Convert comma-separated args into a list
-            checks.append(check)
+
+        for row_number, row in enumerate(reader):
+
+            # Extract setup parameters from rows 2-4
+            if row_number == 1:
+                setup_params["api_ip"] = row[1].strip() # This is the cell
+            elif row_number == 2:
+                setup_params["api_port"] = int(row[1].strip())
+            elif row_number == 3:
+                setup_params["repo_ip"] = row[1].strip()
+
+            # Determine if we're using shorthand or long name
+            elif row_number == 5:
+                anonymize_checks = 1 if row[1].strip() == "Y" else 0
+
+            # Grab the headers of the rows that follow
+            elif row_number == 8:
+                headers = row
+
+            # Extract the checks from rows below.
+            elif row_number > 8:
+                check = {headers[i]: value for i, value in enumerate(row)}
+                check['arg-list'] = check['arg-list'].split(",")  # Convert comma-separated args into a list
+                checks.append(check)
         
-        return setup_params, checks   
+    return setup_params, checks
 
 def sanitize_filename(name):
     """
@@ -71,8 +79,6 @@ def create_publish_checks(checks, api_address, api_port, repo_ip):
         dict: The updated template with all checks and the 'repo-ip' field.
     """
     
-    print(checks)
-    
     # Create the "checks" array as per the new requirements
     checks_array = [
         {
@@ -186,6 +192,65 @@ def create_read_checks(checks, api_address, api_port, repo_ip, score_weight):
     return templates
 
 
+def create_read_results_check(checks, api_address, api_port, repo_ip):
+    """
+    Builds one template reading the results of all of a team's checks
+    through /read-results, instead of one /read-result template per check.
+
+    Dynamicbeat scores it as a single check worth the weight of all the
+    checks, it only passes (200) when every check passed.
+
+    Args:
+        checks (list of dict): List of check definitions with all necessary fields.
+        api_address (str): API address.
+        api_port (int): API port.
+        repo_ip (str): The repository IP address.
+
+    Returns:
+        dict: The batched read template.
+    """
+    body = {
+        "checks": [
+            {
+                "reporting-agent": "{{.TeamNum}}-" + check["target-agent"],
+                "check-ran": check["target-script"],
+                "arg-list": check["arg-list"]
+            }
+            for check in checks
+        ]
+    }
+
+    request = {
+        "host": "{{.API_Address}}",
+        "path": "/read-results",
+        "port": api_port,
+        "https": False,
+        "method": "POST",
+        "headers": {"Content-Type": "application/json"},
+        "matchcode": True,
+        "code": 200,
+        "body": json.dumps(body, separators=(",", ":"))
+    }
+
+    template = {
+        "name": "Read Results",
+        "type": "http",
+        "score_weight": sum(int(check["score-weight"]) for check in checks),
+        "definition": {
+            "requests": [request]
+        },
+        "attributes": {
+            "admin": {
+                "API_Address" : "{{.teamAPIAddress}}",
+                "API_Port": "{{.teamAPIPort}}",
+                "TeamNum": "{{.TeamNum}}"
+            }
+        }
+    }
+
+    return template
+
+
 def replace_api_port(template):
     """Recursively replaces '{{.API_Port}}' with {{.API_Port}} in the dictionary."""
     if isinstance(template, dict):
@@ -200,38 +265,109 @@ def replace_api_port(template):
 
 
 
-def export_templates_to_files(templates, output_dir):
+def render_template(named_template):
+    """
+    Serializes a template the way it is written to its file.
+
+    Args:
+        named_template (tuple): (file name, template dict)
+
+    Returns:
+        tuple: (file name, file content as bytes, sha256 of the content)
+    """
+    file_name, template = named_template
+    content = json.dumps(template, indent=4).encode("utf-8")
+    return file_name, content, hashlib.sha256(content).hexdigest()
+
+
+def manifest_path(output_dir):
+    """
+    The manifest lives next to the output directory, not in it, so it is
+    never uploaded as a check.
+    """
+    return os.path.normpath(output_dir) + ".manifest.json"
+
+
+def load_manifest(output_dir):
+    try:
+        with open(manifest_path(output_dir), "r") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+def export_templates_to_files(templates, output_dir, named_templates=None):
     """
     Exports each template to its own file in the specified directory.
 
+    Only templates whose content changed since the last run are written,
+    templates that are no longer generated are removed. What happened to
+    every file is recorded in the manifest (see manifest_path).
+
     Args:
         templates (list of dict): List of templates to export.
         output_dir (str): Directory where the templates will be saved.
+        named_templates (dict): More templates to export, by file name
+            instead of by their name (e.g. publish-checks.json).
+
+    Returns:
+        dict: The manifest.
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    SSPlaceHolderPrefix = "{{.TeamNum}}-"
+    # This normalizes the filename.
+    # e.g. external-http-http___google.com 
+    # vs. {{.TeamNum}}-external-http-http__google.com
+    named = [(f"{template['name']}.json", template) for template in templates]
+    named.extend((named_templates or {}).items())
 
-    for template in templates:
+    rendered = [render_template(named_template) for named_template in named]
 
-        # Replace the API_Port in the template
-        # replace_api_port(template)
+    previous = load_manifest(output_dir)["files"]
+    files = {}
+    changes = {"added": [], "changed": [], "removed": [], "unchanged": 0}
 
-        # This normalizes the filename.
-        # e.g. external-http-http___google.com 
-        # vs. {{.TeamNum}}-external-http-http__google.com
-        file_name = f"{template['name']}.json"
+    for file_name, content, digest in rendered:
+        files[file_name] = digest
         file_path = os.path.join(output_dir, file_name)
-        
-        with open(file_path, "w") as json_file:
-            json.dump(template, json_file, indent=4)
+
+        if previous.get(file_name) == digest and os.path.exists(file_path):
+            changes["unchanged"] += 1
+            continue
+
+        changes["changed" if file_name in previous else "added"].append(file_name)
+
+        tmp_path = file_path + ".part"
+        with open(tmp_path, "wb") as json_file:
+            json_file.write(content)
+        os.replace(tmp_path, file_path)
+
+    for file_name in previous:
+        if file_name not in files:
+            changes["removed"].append(file_name)
+            file_path = os.path.join(output_dir, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    manifest = {"files": files, "changes": changes}
+    with open(manifest_path(output_dir), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    return manifest
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the Scorestack check templates from a CSV file.")
+    parser.add_argument("--csv", default="checks.csv", help="CSV file containing the checks")
+    parser.add_argument("--output-dir", default="output-checks", help="directory the templates are written to")
+    parser.add_argument("--batched", action="store_true",
+                        help="read all of a team's results with one /read-results template (read-results.json) instead of one template per check")
+    args = parser.parse_args()
+
     # Path to the CSV file containing checks
-    csv_file_path = "checks.csv"
+    csv_file_path = args.csv
 
     # Read checks from the CSV file
     setup_params, checks = read_checks_from_csv(csv_file_path)
@@ -242,18 +378,7 @@ if __name__ == "__main__":
                                                                             setup_params["api_port"], 
                                                                             setup_params["repo_ip"])
 
-    output_dir = "output-checks"
-
-    # Create the output-checks directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-
-    # Export the updated template to a JSON file
-    with open(output_dir + "/publish-checks.json", "w") as json_file:
-        json.dump(updated_template, json_file, indent=4)
-
-    print("Template exported to publish-checks.json")
+    output_dir = args.output_dir
 
     # Print the nicely formatted body
     print("Pretty Body:\n", pretty_body)
@@ -261,10 +386,19 @@ if __name__ == "__main__":
     # Print the single-line body
     print("\nSingle-Line Body:\n", single_line_body)
 
-    updated_templates = create_read_checks(checks, setup_params["api_ip"], setup_params["api_port"], setup_params["repo_ip"], 10)
+    # The publish template goes to publish-checks.json, next to the read templates.
+    named_templates = {"publish-checks.json": updated_template}
+
+    if args.batched:
+        updated_templates = []
+        named_templates["read-results.json"] = create_read_results_check(checks, setup_params["api_ip"], setup_params["api_port"], setup_params["repo_ip"])
+    else:
+        updated_templates = create_read_checks(checks, setup_params["api_ip"], setup_params["api_port"], setup_params["repo_ip"], 10)
 
-    export_templates_to_files(updated_templates, output_dir)
+    manifest = export_templates_to_files(updated_templates, output_dir, named_templates=named_templates)
 
-    print("Read check templates exported to " + output_dir +  " directory")
+    changes = manifest["changes"]
+    print(f"Templates exported to {output_dir}: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+          f"{len(changes['removed'])} removed, {changes['unchanged']} unchanged (see {manifest_path(output_dir)})")
 
 
@@ -1,15 +1,13 @@
 #!/bin/bash 
 
-# Remove the old checks from the Ansible files
-rm -r Ansible/roles/upload-checks/files/output-checks/*
-
-# Remove local old checks. NOTE: Ansible will remove from the remote server
-rm -r output-checks/*
-
+# Only templates that changed are rewritten, checks that are gone are
+# removed (see output-checks.manifest.json). NOTE: Ansible will remove them from the remote server
 python3 check-generator.py
 
 
 # Copy the checks to Ansible directory
+rm -rf Ansible/roles/upload-checks/files/output-checks
+mkdir -p Ansible/roles/upload-checks/files
 cp -r output-checks Ansible/roles/upload-checks/files/
 
 # Change the directory to Ansible
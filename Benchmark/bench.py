@@ -0,0 +1,559 @@
+"""
+    End-to-end load benchmark of CyberSeer.
+
+    Starts a local mosquitto (or uses a broker that is already running), the
+    API (app.py, as its own process), a checks-repo stand-in serving the
+    check scripts, and `--teams` simulated agents with stubbed DNS. It then
+    scores `--rounds` rounds the way Dynamicbeat does: every team's
+    /publish-checks and all of its /read-result calls are fired at once, and
+    a round is over when every /read-result has answered.
+
+    The report is JSON (stdout or `--output`) so runs can be compared
+    between releases:
+        - throughput (scored checks per second) and p50/p99 latency of
+          rounds and of single /read-result calls,
+        - the time from publishing a check to its result landing in the
+          API (api_publish_to_result_seconds from the API's /metrics),
+        - /publish-checks and /read-result answers by status, and the
+          latency of /publish-checks,
+        - messages per second through the broker, by kind,
+        - CPU and RSS of the API and of the agent processes.
+
+    Example:
+        python3 Benchmark/bench.py --teams 50 --checks 30 --rounds 5 --output bench.json
+
+    A result stays fresh in the API for PUBLISH_REPORT_TIMEOUT (45 s), so
+    unless --round-interval is longer than that a /read-result is usually
+    answered with the previous round's result and the round and
+    /read-result latencies measure the API alone. The agents' side of a
+    round (running the check, publishing, the API storing it) is in the
+    publish-to-result figures.
+
+    A run where any /publish-checks did not answer 200 scored checks that
+    never reached the agents: its report lists them under
+    "publish-failures" and the bench exits with status 1.
+
+    Linux only, CPU and RSS are read from /proc.
+"""
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(REPO_ROOT, "Ansible", "Deployment", "docker", "api-agent", "src")
+AGENT_DIR = os.path.join(REPO_ROOT, "Ansible", "Agent-Initialization", "roles", "deploy-agent-service", "files")
+
+# The API always points the agents at port 8080 of the repo-ip.
+CHECKS_REPO_PORT = 8080
+
+# Sleeps for the --check-time it was generated with, like a check waiting on a service.
+CHECK_SCRIPT_SOURCE = """import sys
+import time
+
+time.sleep({check_time})
+print(f"{{sys.argv[1]}} is up")
+"""
+
+
+def check_script(check):
+    # Every check of a team is its own script, like the checks of a real game.
+    return f"bench-check-{check}.py"
+
+
+def agent_name(team):
+    return f"{team}-agent"
+
+
+def agent_address(team):
+    # Made up address each simulated agent claims as its own.
+    return f"10.{team // 65536 % 256}.{team // 256 % 256}.{team % 256}"
+
+
+def percentile(values, pct):
+    """
+        Nearest-rank percentile of `values`, None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(-(-pct * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def latency_summary(values):
+    return {'count': len(values),
+            'p50': percentile(values, 50),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else None}
+
+
+def histogram_delta(before, after):
+    """
+        Summary of what a histogram (as read by API.histogram) observed
+        between two scrapes. The percentiles are bucket upper bounds, e.g.
+        a p99 of 0.5 means 99% were at most 0.5 seconds.
+    """
+    count = int(after['count'] - before['count'])
+    if count <= 0:
+        return {'count': 0}
+
+    summary = {'count': count, 'mean': (after['sum'] - before['sum']) / count}
+    for name, pct in (('p50', 50), ('p99', 99)):
+        for bound, cumulative in sorted(after['buckets'].items()):
+            if cumulative - before['buckets'].get(bound, 0) >= count * pct / 100:
+                summary[name] = bound
+                break
+    return summary
+
+
+def process_usage(pid):
+    """
+        (CPU seconds, RSS bytes) of process `pid` so far.
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        # The command name can contain spaces, the fields we want come after its ')'.
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    return cpu, rss
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on {host}:{port} after {timeout} seconds")
+
+
+# ---------------------------------------------------------------------------
+# Simulated agents, run in their own processes (see run_agent_host)
+# ---------------------------------------------------------------------------
+
+class StaticDNS:
+    """
+        Stand-in for agent.DNSCache answering from a fixed name -> address table.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def lookup(self, name):
+        address = self.table.get(name)
+        return {address} if address is not None else set()
+
+    def resolve(self, name):
+        return self.lookup(name)
+
+    def expired(self, name):
+        return False
+
+
+def run_agent_host(spec_path):
+    """
+        Run the agents described in the JSON file at `spec_path` in this
+        process until it is killed.
+
+        The agents share the working directory (and so the check scripts),
+        like agents of the same image would share their content.
+    """
+    with open(spec_path) as f:
+        spec = json.load(f)
+
+    os.chdir(spec['workdir'])
+    os.makedirs("agent_config", exist_ok=True)
+    sys.path.insert(0, AGENT_DIR)
+    import agent
+    agent.setup_logging()
+
+    class SimulatedAgent(agent.Agent):
+        def __init__(self, address, dns_table):
+            self.address = address
+            super().__init__()
+            self.dns_cache = StaticDNS(dns_table)
+
+        def get_ip_addresses(self):
+            return self.address
+
+    dns_table = {agent_name(team): agent_address(team) for team in spec['all_teams']}
+
+    agents = []
+    for team in spec['teams']:
+        # The agent reads its configuration from a fixed path while it is built.
+        config = dict(spec['config'], agent_names=[agent_name(team)])
+        with open("agent_config/agent_config.json", "w") as f:
+            json.dump(config, f)
+        agents.append(SimulatedAgent(agent_address(team), dns_table))
+
+    for simulated in agents:
+        threading.Thread(target=simulated.run, daemon=True).start()
+
+    while True:
+        time.sleep(3600)
+
+
+# ---------------------------------------------------------------------------
+# The benchmark driver
+# ---------------------------------------------------------------------------
+
+class BrokerCounter:
+    """
+        Subscribes to every topic and counts the messages going through the broker.
+    """
+    def __init__(self, host, port):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.bytes = 0
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = lambda client, userdata, flags, reason_code, properties: client.subscribe("#")
+        self.client.on_message = self.on_message
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    @staticmethod
+    def kind(topic):
+        if topic == "checks" or topic.startswith("checks/"):
+            return "checks"
+        if topic.startswith(("result/", "batch-results/")):
+            return "results"
+        return "other"
+
+    def on_message(self, client, userdata, message):
+        kind = self.kind(message.topic)
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.bytes += len(message.payload)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts), self.bytes
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="cyberseer-bench-")
+        self.processes = []
+
+        if args.broker == "mosquitto":
+            self.mqtt_host, self.mqtt_port = "127.0.0.1", args.mqtt_port
+        else:
+            host, _, port = args.broker.rpartition(":")
+            self.mqtt_host, self.mqtt_port = host, int(port)
+
+        self.api_url = f"http://127.0.0.1:{args.api_port}"
+        self.teams = list(range(1, args.teams + 1))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+        self.session.mount("http://", adapter)
+
+    def log_file(self, name):
+        return open(os.path.join(self.workdir, name), "w")
+
+    def spawn(self, argv, log_name, **kwargs):
+        process = subprocess.Popen(argv, stdout=self.log_file(log_name), stderr=subprocess.STDOUT, **kwargs)
+        self.processes.append(process)
+        return process
+
+    def start_broker(self):
+        if self.args.broker == "mosquitto":
+            mosquitto = shutil.which("mosquitto")
+            if mosquitto is None:
+                raise RuntimeError("mosquitto is not installed, pass --broker HOST:PORT of a running broker")
+            self.spawn([mosquitto, "-p", str(self.mqtt_port)], "mosquitto.log")
+        wait_for_port(self.mqtt_host, self.mqtt_port, 15)
+
+    def start_checks_repo(self):
+        checks = os.path.join(self.workdir, "repo", "checks")
+        os.makedirs(checks)
+        for check in range(self.args.checks):
+            with open(os.path.join(checks, check_script(check)), "w") as f:
+                f.write(CHECK_SCRIPT_SOURCE.format(check_time=self.args.check_time))
+
+        class QuietHandler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        handler = functools.partial(QuietHandler, directory=os.path.join(self.workdir, "repo"))
+        self.checks_repo = http.server.ThreadingHTTPServer(("127.0.0.1", CHECKS_REPO_PORT), handler)
+        threading.Thread(target=self.checks_repo.serve_forever, daemon=True).start()
+
+    def start_api(self):
+        env = dict(os.environ,
+                   MQTT_HOST=self.mqtt_host,
+                   MQTT_PORT=str(self.mqtt_port),
+                   CHECK_ROUTING=self.args.routing,
+                   API_SERVER_MODE=self.args.api_mode,
+                   RESULT_HISTORY=os.path.join(self.workdir, "results.sqlite3"),
+                   PAYLOAD_FORMAT=self.args.payload_format,
+                   API_PORT=str(self.args.api_port))
+        self.api = self.spawn([sys.executable, "app.py"], "api.log", cwd=API_DIR, env=env)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if self.session.get(f"{self.api_url}/metrics", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("The API did not come up, see api.log")
+
+    def start_agents(self):
+        config = {"mqtt_broker": self.mqtt_host,
+                  "mqtt_port": self.mqtt_port,
+                  "message_type_refresh": "refresh",
+                  "message_type_check": "check",
+                  "mqtt_sub_topic_list": ["checks", "refresh"],
+                  "check_topic_num": 0,
+                  "check_routing": self.args.routing,
+                  "refresh_topic_num": 1,
+                  "mqtt_pub_topic_list": ["results"],
+                  "pub_topic_num": 0,
+                  "dns_server": "127.0.0.1",
+                  "payload_format": self.args.payload_format}
+        config.update(self.args.agent_config)
+
+        self.agent_hosts = []
+        count = max(min(self.args.agent_processes, len(self.teams)), 1)
+        for index in range(count):
+            workdir = os.path.join(self.workdir, f"agents-{index}")
+            os.makedirs(workdir)
+            spec_path = os.path.join(workdir, "spec.json")
+            with open(spec_path, "w") as f:
+                json.dump({'workdir': workdir,
+                           'teams': self.teams[index::count],
+                           'all_teams': self.teams,
+                           'config': config}, f)
+            self.agent_hosts.append(self.spawn([sys.executable, os.path.abspath(__file__), "--agent-host", spec_path],
+                                               f"agents-{index}.log"))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if getattr(self, "checks_repo", None) is not None:
+            self.checks_repo.shutdown()
+        if not self.args.keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def publish_body(self, team):
+        return {"repo-ip": "127.0.0.1",
+                "checks": [{"target-agent": agent_name(team),
+                            "target-script": check_script(check),
+                            "run-method": "python",
+                            "arg-list": [f"service-{check}"]}
+                           for check in range(self.args.checks)]}
+
+    def read_body(self, team, check):
+        return {"reporting-agent": agent_name(team),
+                "check-ran": check_script(check),
+                "arg-list": [f"service-{check}"]}
+
+    def post(self, path, body):
+        started = time.perf_counter()
+        try:
+            status = self.session.post(f"{self.api_url}{path}", json=body, timeout=60).status_code
+        except requests.RequestException:
+            status = "error"
+        return path, status, time.perf_counter() - started
+
+    def score_round(self, pool):
+        """
+            One Dynamicbeat round. Returns (seconds, list of (path, status, seconds)).
+        """
+        started = time.perf_counter()
+        futures = [pool.submit(self.post, "/publish-checks", self.publish_body(team)) for team in self.teams]
+        futures += [pool.submit(self.post, "/read-result", self.read_body(team, check))
+                    for team in self.teams for check in range(self.args.checks)]
+        answers = [future.result() for future in futures]
+        return time.perf_counter() - started, answers
+
+    def histogram(self, name):
+        """
+            Cumulative buckets, sum and count of a histogram on the API's /metrics.
+        """
+        text = self.session.get(f"{self.api_url}/metrics", timeout=10).text
+        histogram = {'buckets': {}, 'sum': 0.0, 'count': 0}
+        for match in re.finditer(rf'^{name}_bucket{{le="([^"]+)"}} (\S+)$', text, re.MULTILINE):
+            histogram['buckets'][float(match.group(1))] = float(match.group(2))
+        for field in ('sum', 'count'):
+            match = re.search(rf'^{name}_{field} (\S+)$', text, re.MULTILINE)
+            if match:
+                histogram[field] = float(match.group(1))
+        return histogram
+
+    def usage(self):
+        api = process_usage(self.api.pid)
+        agents = [process_usage(process.pid) for process in self.agent_hosts]
+        return {'api': api,
+                'agents': (sum(cpu for cpu, rss in agents), sum(rss for cpu, rss in agents))}
+
+    def run(self):
+        self.start_broker()
+        self.start_checks_repo()
+        self.start_api()
+        self.start_agents()
+        counter = BrokerCounter(self.mqtt_host, self.mqtt_port)
+
+        rounds = []
+        latencies = {"/publish-checks": [], "/read-result": []}
+        statuses = {"/publish-checks": {}, "/read-result": {}}
+        peak_rss = {'api': 0, 'agents': 0}
+
+        with concurrent.futures.ThreadPoolExecutor(self.args.concurrency) as pool:
+            # Warm up: agents connect and download the check script, not measured.
+            for _ in range(self.args.warmup_rounds):
+                self.score_round(pool)
+                time.sleep(self.args.round_interval)
+
+            usage_before = self.usage()
+            messages_before, bytes_before = counter.snapshot()
+            publish_to_result_before = self.histogram("api_publish_to_result_seconds")
+            started = time.perf_counter()
+
+            for number in range(self.args.rounds):
+                seconds, answers = self.score_round(pool)
+
+                round_statuses = {path: {} for path in statuses}
+                for path, status, latency in answers:
+                    latencies[path].append(latency)
+                    round_statuses[path][str(status)] = round_statuses[path].get(str(status), 0) + 1
+                for path, counts in round_statuses.items():
+                    for status, count in counts.items():
+                        statuses[path][status] = statuses[path].get(status, 0) + count
+                rounds.append({'round': number, 'seconds': seconds,
+                               'publish-checks': round_statuses["/publish-checks"],
+                               'read-result': round_statuses["/read-result"]})
+
+                for name, (cpu, rss) in self.usage().items():
+                    peak_rss[name] = max(peak_rss[name], rss)
+
+                time.sleep(self.args.round_interval)
+
+            elapsed = time.perf_counter() - started
+            usage_after = self.usage()
+            messages_after, bytes_after = counter.snapshot()
+
+            # The last round's results may still be on their way.
+            time.sleep(self.args.check_time + 1)
+            publish_to_result_after = self.histogram("api_publish_to_result_seconds")
+
+        counter.stop()
+
+        scored = len(self.teams) * self.args.checks * self.args.rounds
+        processes = {}
+        for name in ('api', 'agents'):
+            cpu = usage_after[name][0] - usage_before[name][0]
+            processes[name] = {'cpu-seconds': cpu,
+                               'cpu-percent': 100 * cpu / elapsed,
+                               'peak-rss-bytes': peak_rss[name]}
+        processes['agents']['processes'] = len(self.agent_hosts)
+
+        return {'config': {'teams': self.args.teams,
+                           'checks': self.args.checks,
+                           'rounds': self.args.rounds,
+                           'routing': self.args.routing,
+                           'payload-format': self.args.payload_format,
+                           'api-mode': self.args.api_mode,
+                           'check-time': self.args.check_time,
+                           'agent-processes': len(self.agent_hosts),
+                           'agent-config': self.args.agent_config},
+                'elapsed-seconds': elapsed,
+                'throughput-checks-per-second': scored / elapsed,
+                'round-seconds': latency_summary([r['seconds'] for r in rounds]),
+                'publish-checks-seconds': latency_summary(latencies["/publish-checks"]),
+                'publish-checks-status': statuses["/publish-checks"],
+                'publish-failures': sum(count for status, count in statuses["/publish-checks"].items() if status != "200"),
+                'read-result-seconds': latency_summary(latencies["/read-result"]),
+                'read-result-status': statuses["/read-result"],
+                'publish-to-result-seconds': histogram_delta(publish_to_result_before, publish_to_result_after),
+                'broker': {'messages-per-second': {kind: (messages_after.get(kind, 0) - messages_before.get(kind, 0)) / elapsed
+                                                   for kind in messages_after},
+                           'bytes-per-second': (bytes_after - bytes_before) / elapsed},
+                'processes': processes,
+                'rounds': rounds}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark of CyberSeer.")
+    parser.add_argument("--teams", type=int, default=10, help="simulated agents, one per team")
+    parser.add_argument("--checks", type=int, default=30, help="checks per team per round")
+    parser.add_argument("--rounds", type=int, default=5, help="measured rounds")
+    parser.add_argument("--warmup-rounds", type=int, default=1, help="rounds scored before measuring")
+    parser.add_argument("--round-interval", type=float, default=1.0, help="seconds between rounds")
+    parser.add_argument("--check-time", type=float, default=0.05, help="seconds the check script runs")
+    parser.add_argument("--broker", default="mosquitto",
+                        help="'mosquitto' to start one on --mqtt-port, or HOST:PORT of a running MQTTv5 broker")
+    parser.add_argument("--mqtt-port", type=int, default=18830)
+    parser.add_argument("--api-port", type=int, default=5000, help="port the API is started on")
+    parser.add_argument("--api-mode", choices=("flask", "async"), default="flask")
+    parser.add_argument("--routing", choices=("broadcast", "routed"), default="broadcast")
+    parser.add_argument("--payload-format", choices=("json", "msgpack"), default="json",
+                        help="format of the check and result messages")
+    parser.add_argument("--agent-processes", type=int, default=1, help="processes the simulated agents are spread over")
+    parser.add_argument("--agent-config", type=json.loads, default={},
+                        help='JSON object of agent_config.json overrides, e.g. \'{"python_execution": "warm"}\'')
+    parser.add_argument("--concurrency", type=int, default=256, help="HTTP requests in flight at once")
+    parser.add_argument("--output", default="-", help="file to write the JSON report to, - for stdout")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep the logs and agent directories")
+    parser.add_argument("--agent-host", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.agent_host:
+        run_agent_host(args.agent_host)
+        return
+
+    bench = Benchmark(args)
+    try:
+        report = bench.run()
+    finally:
+        bench.stop()
+
+    if args.keep_workdir:
+        report['workdir'] = bench.workdir
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if report['publish-failures']:
+        print(f"{report['publish-failures']} /publish-checks calls failed: {report['publish-checks-status']}",
+              file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())